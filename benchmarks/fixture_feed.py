@@ -0,0 +1,240 @@
+"""Deterministic synthetic GTFS feed for the benchmarks.
+
+The feed is a grid of stops about 330 meters apart, served by straight and diagonal
+routes in both directions, with express trips that skip every other stop, walking
+transfers between nearby stops and a shape for every route direction. Nothing is
+random and every written value is rounded, so the same files are written on every run
+and the recorded oracles stay valid.
+
+Usage:
+    python benchmarks/fixture_feed.py [PATH]
+"""
+
+import math
+import os
+import sys
+
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FIXTURE_NAME = "fixture_2021_06_01"
+DEFAULT_PATH = os.path.join(BENCHMARK_DIR, ".fixtures", FIXTURE_NAME)
+
+GRID_SIZE = 12
+ORIGIN = (38.55, -121.45)
+# degrees between neighbouring stops, about 330 meters either way
+SPACING = (0.003, 0.0038)
+
+FIRST_DEPARTURE = 5 * 60 * 60
+LAST_DEPARTURE = 11 * 60 * 60
+
+# Transfers are written between stops closer than this, walking at 55 meters / minute
+TRANSFER_DISTANCE = 400
+WALK_SPEED = 55
+EARTH_RADIUS = 6371008.8
+
+# Routes and their stops, as (row, column) positions on the grid
+ROUTES = {
+    "R1": [(1, j) for j in range(GRID_SIZE)],
+    "R2": [(4, j) for j in range(GRID_SIZE)],
+    "R3": [(7, j) for j in range(GRID_SIZE)],
+    "R4": [(10, j) for j in range(GRID_SIZE)],
+    "C1": [(i, 2) for i in range(GRID_SIZE)],
+    "C2": [(i, 5) for i in range(GRID_SIZE)],
+    "C3": [(i, 8) for i in range(GRID_SIZE)],
+    "C4": [(i, 11) for i in range(GRID_SIZE)],
+    "D1": [(i, i) for i in range(GRID_SIZE)],
+    "D2": [(i, GRID_SIZE - 1 - i) for i in range(GRID_SIZE)],
+}
+
+# Every third trip of these routes only stops at every other stop
+EXPRESS_ROUTES = ["R2", "C2"]
+
+# These routes stop at platforms beside the grid stops, about 80 meters north
+PLATFORM_ROUTES = ["D1", "D2"]
+PLATFORM_OFFSET = 0.0007
+
+
+def _stop_id(i: int, j: int, platform: bool = False) -> str:
+    return str(100 + (GRID_SIZE * GRID_SIZE if platform else 0) + i * GRID_SIZE + j)
+
+
+def _coordinates(i: int, j: int, platform: bool = False):
+    return (
+        round(ORIGIN[0] + i * SPACING[0] + (PLATFORM_OFFSET if platform else 0), 6),
+        round(ORIGIN[1] + j * SPACING[1], 6),
+    )
+
+
+def _format_time(seconds: int) -> str:
+    return "{:02d}:{:02d}:{:02d}".format(
+        seconds // 3600, (seconds % 3600) // 60, seconds % 60
+    )
+
+
+def _stops() -> pd.DataFrame:
+    stops = [
+        (_stop_id(i, j), "STOP {}-{}".format(i, j)) + _coordinates(i, j)
+        for i in range(GRID_SIZE)
+        for j in range(GRID_SIZE)
+    ]
+    platforms = sorted({position for r in PLATFORM_ROUTES for position in ROUTES[r]})
+    stops.extend(
+        (_stop_id(i, j, True), "PLATFORM {}-{}".format(i, j)) + _coordinates(i, j, True)
+        for i, j in platforms
+    )
+    return pd.DataFrame(stops, columns=["stop_id", "stop_name", "stop_lat", "stop_lon"])
+
+
+def _shape_points(shape_id: str, positions, platform: bool) -> list:
+    """The stops of a route direction, with a slightly offset point between each."""
+    points = []
+    for n, (i, j) in enumerate(positions):
+        lat, lon = _coordinates(i, j, platform)
+        points.append((shape_id, lat, lon, len(points) + 1))
+        if n + 1 < len(positions):
+            next_lat, next_lon = _coordinates(*positions[n + 1], platform)
+            offset = 0.00004 if n % 2 == 0 else -0.00004
+            points.append(
+                (
+                    shape_id,
+                    round((lat + next_lat) / 2 + offset, 6),
+                    round((lon + next_lon) / 2 - offset, 6),
+                    len(points) + 1,
+                )
+            )
+    return points
+
+
+def _transfers(stops: pd.DataFrame) -> pd.DataFrame:
+    transfers = []
+    for from_stop in stops.itertuples(index=False):
+        for to_stop in stops.itertuples(index=False):
+            if from_stop.stop_id == to_stop.stop_id:
+                continue
+            lat = math.radians((from_stop.stop_lat + to_stop.stop_lat) / 2)
+            distance = EARTH_RADIUS * math.hypot(
+                math.radians(to_stop.stop_lat - from_stop.stop_lat),
+                math.radians(to_stop.stop_lon - from_stop.stop_lon) * math.cos(lat),
+            )
+            if distance <= TRANSFER_DISTANCE:
+                transfers.append(
+                    (
+                        from_stop.stop_id,
+                        to_stop.stop_id,
+                        2,
+                        int(round(distance / WALK_SPEED * 60)),
+                    )
+                )
+
+    return pd.DataFrame(
+        transfers,
+        columns=["from_stop_id", "to_stop_id", "transfer_type", "min_transfer_time"],
+    )
+
+
+def write_fixture_feed(path: str = DEFAULT_PATH) -> str:
+    """Write the fixture feed to a directory, if it is not there already.
+
+    :param path: Directory the GTFS files are written to
+    :return: The directory
+    """
+    if os.path.exists(os.path.join(path, "stop_times.txt")):
+        return path
+    os.makedirs(path, exist_ok=True)
+
+    routes = []
+    trips = []
+    stop_times = []
+    shapes = []
+    for r, (route_id, positions) in enumerate(ROUTES.items()):
+        routes.append(
+            (route_id, "AG", route_id, "LINE {}".format(route_id), 3, "0000FF")
+        )
+        headway = 600 + 120 * r
+        platform = route_id in PLATFORM_ROUTES
+
+        for direction in (0, 1):
+            pattern = positions if direction == 0 else positions[::-1]
+            shape_id = "{}_{}".format(route_id, direction)
+            shapes.extend(_shape_points(shape_id, pattern, platform))
+
+            departure = FIRST_DEPARTURE + 60 * r + 30 * direction
+            n = 0
+            while departure < LAST_DEPARTURE:
+                trip_id = "{}_{}_{}".format(route_id, direction, n)
+                is_express = route_id in EXPRESS_ROUTES and n % 3 == 2
+                trips.append((route_id, "WK", trip_id, direction, shape_id))
+
+                time = departure
+                served = [
+                    position
+                    for q, position in enumerate(pattern)
+                    if not is_express or q % 2 == 0 or q == len(pattern) - 1
+                ]
+                for q, (i, j) in enumerate(served):
+                    dwell = 30 if q % 4 == 0 else 0
+                    stop_times.append(
+                        (
+                            trip_id,
+                            _format_time(time),
+                            _format_time(time + dwell),
+                            _stop_id(i, j, platform),
+                            q + 1,
+                        )
+                    )
+                    time += dwell + (230 if is_express else 120)
+                    time += (7 * len(trips) + 13 * q) % 20
+
+                departure += headway
+                n += 1
+
+    stops = _stops()
+    stops.to_csv(os.path.join(path, "stops.txt"), index=False)
+    _transfers(stops).to_csv(os.path.join(path, "transfers.txt"), index=False)
+    pd.DataFrame(
+        routes,
+        columns=[
+            "route_id",
+            "agency_id",
+            "route_short_name",
+            "route_long_name",
+            "route_type",
+            "route_color",
+        ],
+    ).to_csv(os.path.join(path, "routes.txt"), index=False)
+    pd.DataFrame(
+        trips,
+        columns=["route_id", "service_id", "trip_id", "direction_id", "shape_id"],
+    ).to_csv(os.path.join(path, "trips.txt"), index=False)
+    pd.DataFrame(
+        stop_times,
+        columns=[
+            "trip_id",
+            "arrival_time",
+            "departure_time",
+            "stop_id",
+            "stop_sequence",
+        ],
+    ).to_csv(os.path.join(path, "stop_times.txt"), index=False)
+    pd.DataFrame(
+        shapes,
+        columns=["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"],
+    ).to_csv(os.path.join(path, "shapes.txt"), index=False)
+
+    with open(os.path.join(path, "agency.txt"), "w") as f:
+        f.write("agency_id,agency_name,agency_url,agency_timezone\n")
+        f.write("AG,Fixture Transit,http://example.com,America/Los_Angeles\n")
+    with open(os.path.join(path, "calendar.txt"), "w") as f:
+        f.write(
+            "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,"
+            "start_date,end_date\n"
+        )
+        f.write("WK,1,1,1,1,1,0,0,20210601,20210630\n")
+
+    return path
+
+
+if __name__ == "__main__":
+    print(write_fixture_feed(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH))
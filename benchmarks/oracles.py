@@ -0,0 +1,193 @@
+"""Reference implementations the benchmark results are checked against.
+
+None of these use gtfs_router, so the oracles they record stay independent of the
+code being benchmarked:
+    find_transfers: the cross join of every pair of stops, as find_transfers was
+        first written
+    raptor: a plain scan of every trip in every round, with the same rules as RAPTOR
+        (a footpath from the origin, then up to transfer_limit + 1 trips, each
+        followed by a footpath)
+    shape_dist_traveled: projecting each stop onto the part of the shape left after
+        the previous stop, and cutting the shape there, as generate_shape_dist_traveled
+        was first written
+
+The first RAPTOR implementation is not used for the routing oracles. It spends a round
+on the walk from the origin, and even with rounds to spare it misses earlier arrivals
+that the scan above finds.
+"""
+
+import math
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+# Defaults of find_transfers
+BUFFER_DISTANCE = 150
+WALK_SPEED = 55
+EPSG = 5070
+
+
+def _project(lon: np.ndarray, lat: np.ndarray, epsg: int = EPSG):
+    import pyproj
+
+    return pyproj.Transformer.from_crs(
+        pyproj.CRS("EPSG:4326"), pyproj.CRS.from_epsg(epsg), always_xy=True
+    ).transform(lon, lat)
+
+
+def find_transfers(stops: pd.DataFrame) -> pd.DataFrame:
+    """Transfers between every pair of stops closer than the buffer distance."""
+    x, y = _project(
+        stops["stop_lon"].to_numpy(dtype=float), stops["stop_lat"].to_numpy(dtype=float)
+    )
+    stop_ids = stops["stop_id"].to_numpy()
+
+    dist = np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :])
+    from_rows, to_rows = np.nonzero(
+        (dist <= BUFFER_DISTANCE) & (stop_ids[:, None] != stop_ids[None, :])
+    )
+
+    transfers = pd.DataFrame(
+        {
+            "from_stop_id": stop_ids[from_rows],
+            "to_stop_id": stop_ids[to_rows],
+            "min_transfer_time": dist[from_rows, to_rows] / WALK_SPEED * 60,
+        }
+    )
+    return transfers.sort_values(["from_stop_id", "to_stop_id"])
+
+
+class TripScan:
+    def __init__(self, feed):
+        """Earliest arrivals found by scanning every trip of a feed in every round.
+
+        :param feed: A Partridge GTFS datafeed, with its transfers as the footpaths
+        """
+        stop_times = feed.stop_times.sort_values(["trip_id", "stop_sequence"])
+        stop_times = stop_times.assign(
+            arrival_time=stop_times["arrival_time"].fillna(
+                stop_times["departure_time"]
+            ),
+            departure_time=stop_times["departure_time"].fillna(
+                stop_times["arrival_time"]
+            ),
+        )
+        self.trips = [
+            (
+                group["stop_id"].tolist(),
+                group["arrival_time"].tolist(),
+                group["departure_time"].tolist(),
+            )
+            for _, group in stop_times.groupby("trip_id", sort=True)
+        ]
+
+        self.footpaths = defaultdict(list)
+        for from_stop_id, to_stop_id, walk_time in feed.transfers[
+            ["from_stop_id", "to_stop_id", "min_transfer_time"]
+        ].itertuples(index=False, name=None):
+            if not pd.isna(walk_time):
+                self.footpaths[from_stop_id].append((to_stop_id, float(walk_time)))
+
+    def arrival(
+        self,
+        from_stop_id: str,
+        to_stop_id: str,
+        departure_time: float,
+        transfer_limit: int,
+    ) -> float:
+        best = defaultdict(lambda: math.inf)
+        best_transit = defaultdict(lambda: math.inf)
+
+        best[from_stop_id] = departure_time
+        for stop_id, walk_time in self.footpaths[from_stop_id]:
+            best[stop_id] = min(best[stop_id], departure_time + walk_time)
+
+        for _ in range(transfer_limit + 1):
+            previous = dict(best)
+            improved = set()
+            for stop_ids, arrivals, departures in self.trips:
+                boarded = False
+                for stop_id, arrival, departure in zip(stop_ids, arrivals, departures):
+                    if boarded and arrival < best_transit[stop_id]:
+                        best_transit[stop_id] = arrival
+                        improved.add(stop_id)
+                    if not boarded and previous.get(stop_id, math.inf) <= departure:
+                        boarded = True
+
+            for stop_id in improved:
+                best[stop_id] = min(best[stop_id], best_transit[stop_id])
+            for stop_id in improved:
+                for walk_to, walk_time in self.footpaths[stop_id]:
+                    best[walk_to] = min(
+                        best[walk_to], best_transit[stop_id] + walk_time
+                    )
+
+        return best[to_stop_id] if math.isfinite(best[to_stop_id]) else np.nan
+
+
+def raptor_arrivals(feed, queries: pd.DataFrame, transfer_limit: int) -> pd.DataFrame:
+    """Earliest arrival of every query, as recorded by the routing benchmarks."""
+    scan = TripScan(feed)
+    return queries.assign(
+        arrival_time=[
+            scan.arrival(from_stop_id, to_stop_id, departure_time, transfer_limit)
+            for from_stop_id, to_stop_id, departure_time in queries[
+                ["from_stop_id", "to_stop_id", "departure_time"]
+            ].itertuples(index=False, name=None)
+        ]
+    )
+
+
+def _cut(line, distance: float):
+    """The part of a line after a distance along it."""
+    from shapely.geometry import LineString, Point
+
+    if distance <= 0.0 or distance >= line.length:
+        return line
+
+    coords = list(line.coords)
+    for i, point in enumerate(coords):
+        projected = line.project(Point(point))
+        if projected == distance:
+            return LineString(coords[i:])
+        if projected > distance:
+            cut_point = line.interpolate(distance)
+            return LineString([(cut_point.x, cut_point.y)] + coords[i:])
+
+    # a line crossing itself is left whole
+    return line
+
+
+def shape_dist_traveled(feed) -> pd.DataFrame:
+    """Distance along the shape of its trip to every stop time."""
+    shapes = (
+        feed.shapes.to_crs(epsg=EPSG)
+        .drop_duplicates("shape_id")
+        .set_index("shape_id")["geometry"]
+    )
+    stops = (
+        feed.stops.to_crs(epsg=EPSG)
+        .drop_duplicates("stop_id")
+        .set_index("stop_id")["geometry"]
+    )
+    trip_shapes = feed.trips.drop_duplicates("trip_id").set_index("trip_id")["shape_id"]
+    stop_times = feed.stop_times.sort_values(["trip_id", "stop_sequence"])
+
+    distances = []
+    for trip_id, stop_ids in stop_times.groupby("trip_id", sort=True)["stop_id"]:
+        line = shapes[trip_shapes[trip_id]]
+        dist = 0.0
+        for stop_id in stop_ids:
+            projected = line.project(stops[stop_id])
+            line = _cut(line, projected)
+            dist += projected
+            distances.append(dist)
+
+    return pd.DataFrame(
+        {
+            "trip_id": stop_times["trip_id"].to_numpy(),
+            "stop_sequence": stop_times["stop_sequence"].to_numpy(),
+            "shape_dist_traveled": distances,
+        }
+    )
@@ -0,0 +1,413 @@
+"""Benchmarks for routing, transfer generation and shape distances.
+
+Each benchmark runs in a fresh process on a GTFS feed, by default the synthetic feed
+written by benchmarks/fixture_feed.py, and reports:
+    p50 / p95: latency of a single operation, in seconds
+    throughput: operations per second
+    peak_rss_mb: peak resident memory of the benchmark process
+    compile_time: seconds to load and compile the feed before the operations
+
+Routing queries are pairs of stops of the feed sampled by a seeded generator, or the
+OD pairs of a file laid out like data/matches.csv whose stops are in the feed, with
+departure times drawn from the AM peak by the same generator.
+
+Metrics are compared against benchmarks/baselines.json, and a run fails when a
+latency, compile time or memory metric is worse than its baseline by more than the
+threshold. --update-baselines records the metrics of the run as the new baselines.
+
+Every benchmark also checks its results (arrival times, transfers or distances)
+against the oracle files in benchmarks/oracle. The oracles are recorded with
+--record-oracles from the reference implementations of benchmarks/oracles.py, never
+from the code being benchmarked.
+
+Benchmarks that need stop_times.txt are skipped on feeds without it, such as the
+bundled Sacramento feed.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--feed PATH] [--matches PATH]
+        [--benchmarks NAME ...] [--queries N] [--seed N] [--threshold FRACTION]
+        [--update-baselines] [--record-oracles]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import warnings
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import oracles
+from fixture_feed import DEFAULT_PATH as FIXTURE_FEED
+from fixture_feed import write_fixture_feed
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BASELINES = os.path.join(BENCHMARK_DIR, "baselines.json")
+ORACLE_DIR = os.path.join(BENCHMARK_DIR, "oracle")
+
+DEFAULT_QUERIES = 200
+DEFAULT_SEED = 0
+DEFAULT_TRANSFER_LIMIT = 2
+
+# A metric regresses when it is worse than its baseline by more than this fraction
+DEFAULT_THRESHOLD = 0.2
+
+# Departure times of the sampled queries, in seconds
+AM_PEAK = (6 * 60 * 60, 9 * 60 * 60)
+
+# Repetitions of the benchmarks timing a whole-feed operation, after an untimed one
+REPEATS = 10
+
+# Metrics where a larger value is a regression, and their oracle tolerances
+REGRESSION_METRICS = ["p50", "p95", "compile_time", "peak_rss_mb"]
+ARRIVAL_TOLERANCE = 1e-2
+DISTANCE_TOLERANCE = 1e-6
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _metrics(latencies, compile_time: float) -> dict:
+    latencies = np.asarray(latencies, dtype=float)
+    return {
+        "operations": len(latencies),
+        "p50": float(np.percentile(latencies, 50)) if len(latencies) else np.nan,
+        "p95": float(np.percentile(latencies, 95)) if len(latencies) else np.nan,
+        "throughput": (
+            float(len(latencies) / latencies.sum()) if latencies.sum() > 0 else np.nan
+        ),
+        "compile_time": compile_time,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _require_stop_times(feed_path: str):
+    if not os.path.exists(os.path.join(feed_path, "stop_times.txt")):
+        raise SkipBenchmark("stop_times.txt is missing from {}".format(feed_path))
+
+
+def _load_feed(feed_path: str):
+    import partridge as ptg
+
+    _, service_ids = ptg.read_busiest_date(feed_path)
+    return ptg.load_geo_feed(feed_path, {"trips.txt": {"service_id": service_ids}})
+
+
+def _od_pairs(matches_path: Optional[str], stop_ids) -> pd.DataFrame:
+    """Every pair of distinct stops, or the pairs of matches.csv that are in the feed."""
+    if matches_path is None:
+        stop_ids = np.sort(np.unique(np.asarray(stop_ids, dtype=str)))
+        from_rows, to_rows = np.nonzero(stop_ids[:, None] != stop_ids[None, :])
+        return pd.DataFrame(
+            {"from_stop_id": stop_ids[from_rows], "to_stop_id": stop_ids[to_rows]}
+        )
+
+    # the OD pairs are read without their times, departure times are drawn instead
+    od_records = pd.read_csv(matches_path, index_col=0, dtype=str).iloc[:, 1:3]
+    od_records.columns = ["from_stop_id", "to_stop_id"]
+    od_records = od_records[
+        od_records["from_stop_id"].isin(stop_ids)
+        & od_records["to_stop_id"].isin(stop_ids)
+        & (od_records["from_stop_id"] != od_records["to_stop_id"])
+    ]
+    if od_records.empty:
+        raise SkipBenchmark("No OD pair of {} is in the feed".format(matches_path))
+    return od_records
+
+
+def sample_queries(
+    matches_path: Optional[str], stop_ids, num_queries: int, seed: int
+) -> pd.DataFrame:
+    """Sample OD queries from the stops of the feed, or the pairs of matches.csv."""
+    od_records = _od_pairs(matches_path, stop_ids)
+
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(od_records), min(num_queries, len(od_records)), replace=False)
+    return pd.DataFrame(
+        {
+            "from_stop_id": od_records["from_stop_id"].to_numpy()[np.sort(rows)],
+            "to_stop_id": od_records["to_stop_id"].to_numpy()[np.sort(rows)],
+            "departure_time": np.round(rng.uniform(*AM_PEAK, size=len(rows)), 0),
+        }
+    )
+
+
+def _route_queries(args, one_to_all: bool):
+    from gtfs_router.raptor import compile_timetable, raptor_assignment
+
+    _require_stop_times(args.feed)
+
+    tic = time.perf_counter()
+    feed = _load_feed(args.feed)
+    timetable = compile_timetable(feed)
+    compile_time = time.perf_counter() - tic
+
+    queries = sample_queries(
+        args.matches, feed.stops["stop_id"], args.queries, args.seed
+    )
+
+    latencies = []
+    arrivals = []
+    for from_stop_id, to_stop_id, departure_time in queries.itertuples(
+        index=False, name=None
+    ):
+        tic = time.perf_counter()
+        stop_state = raptor_assignment(
+            feed,
+            from_stop_id,
+            None if one_to_all else to_stop_id,
+            departure_time,
+            None,
+            DEFAULT_TRANSFER_LIMIT,
+            timetable=timetable,
+        )
+        latencies.append(time.perf_counter() - tic)
+
+        arrivals.append(
+            departure_time + stop_state.get_stop(to_stop_id)["time_to_reach"]
+            if stop_state.has_stop(to_stop_id)
+            else np.nan
+        )
+
+    return _metrics(latencies, compile_time), queries.assign(arrival_time=arrivals)
+
+
+def bench_raptor_p2p(args):
+    """Point-to-point queries, pruned by the destination."""
+    return _route_queries(args, one_to_all=False)
+
+
+def bench_raptor_one_to_all(args):
+    """One-to-all queries, reading the arrival at the sampled destination."""
+    return _route_queries(args, one_to_all=True)
+
+
+def bench_find_transfers(args):
+    """Walking transfers between every pair of stops of the feed."""
+    import geopandas as gpd
+
+    from gtfs_router.utils import find_transfers
+
+    tic = time.perf_counter()
+    stops = pd.read_csv(os.path.join(args.feed, "stops.txt"), dtype={"stop_id": str})
+    stops = gpd.GeoDataFrame(
+        stops,
+        geometry=gpd.points_from_xy(stops["stop_lon"], stops["stop_lat"]),
+        crs="EPSG:4326",
+    )
+    compile_time = time.perf_counter() - tic
+
+    find_transfers(stops)
+    latencies = []
+    for _ in range(REPEATS):
+        tic = time.perf_counter()
+        transfers = find_transfers(stops)
+        latencies.append(time.perf_counter() - tic)
+
+    transfers = transfers.sort_values(["from_stop_id", "to_stop_id"])
+    return (
+        _metrics(latencies, compile_time),
+        transfers[["from_stop_id", "to_stop_id", "min_transfer_time"]],
+    )
+
+
+def bench_shape_dist_traveled(args):
+    """Distance along the trip shape to every stop time, in a single process."""
+    from gtfs_router.utils import generate_shape_dist_traveled
+
+    _require_stop_times(args.feed)
+
+    tic = time.perf_counter()
+    feed = _load_feed(args.feed)
+    compile_time = time.perf_counter() - tic
+
+    generate_shape_dist_traveled(feed, overwrite=True, workers=1)
+    latencies = []
+    for _ in range(REPEATS):
+        tic = time.perf_counter()
+        stop_times = generate_shape_dist_traveled(feed, overwrite=True, workers=1)
+        latencies.append(time.perf_counter() - tic)
+
+    return (
+        _metrics(latencies, compile_time),
+        stop_times[["trip_id", "stop_sequence", "shape_dist_traveled"]],
+    )
+
+
+BENCHMARKS = {
+    "raptor_p2p": bench_raptor_p2p,
+    "raptor_one_to_all": bench_raptor_one_to_all,
+    "find_transfers": bench_find_transfers,
+    "shape_dist_traveled": bench_shape_dist_traveled,
+}
+
+
+def _run_benchmark(name: str, args):
+    # progress messages would be timed along with the operations
+    logging.disable(logging.INFO)
+    warnings.filterwarnings("ignore")
+    try:
+        return BENCHMARKS[name](args)
+    except SkipBenchmark as e:
+        return str(e), None
+
+
+def _record_oracle(name: str, args) -> pd.DataFrame:
+    """Results of the reference implementation of a benchmark, for its oracle file."""
+    if name == "find_transfers":
+        return oracles.find_transfers(
+            pd.read_csv(os.path.join(args.feed, "stops.txt"), dtype={"stop_id": str})
+        )
+
+    _require_stop_times(args.feed)
+    feed = _load_feed(args.feed)
+    if name == "shape_dist_traveled":
+        return oracles.shape_dist_traveled(feed)
+
+    queries = sample_queries(
+        args.matches, feed.stops["stop_id"], args.queries, args.seed
+    )
+    return oracles.raptor_arrivals(feed, queries, DEFAULT_TRANSFER_LIMIT)
+
+
+def _check_oracle(name: str, expected: pd.DataFrame, results: pd.DataFrame) -> str:
+    """Compare the results of a benchmark with those recorded, empty if they match."""
+    if name.startswith("raptor"):
+        keys = ["from_stop_id", "to_stop_id", "departure_time"]
+        column, tolerance = "arrival_time", ARRIVAL_TOLERANCE
+    elif name == "find_transfers":
+        keys = ["from_stop_id", "to_stop_id"]
+        column, tolerance = "min_transfer_time", DISTANCE_TOLERANCE
+    else:
+        keys = ["trip_id", "stop_sequence"]
+        column, tolerance = "shape_dist_traveled", DISTANCE_TOLERANCE
+
+    if len(expected) != len(results):
+        return "{} rows, expected {}".format(len(results), len(expected))
+    if not (
+        expected[keys].astype(str).to_numpy() == results[keys].astype(str).to_numpy()
+    ).all():
+        return "rows differ from the oracle"
+
+    is_close = np.isclose(
+        results[column].to_numpy(dtype=float),
+        expected[column].to_numpy(dtype=float),
+        rtol=tolerance if name == "shape_dist_traveled" else 0,
+        atol=tolerance,
+        equal_nan=True,
+    )
+    if not is_close.all():
+        return "{} of {} {} values differ from the oracle".format(
+            (~is_close).sum(), len(is_close), column
+        )
+    return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--feed", help="defaults to the fixture feed")
+    parser.add_argument(
+        "--matches", help="OD pairs to sample, defaults to pairs of feed stops"
+    )
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS))
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--update-baselines", action="store_true")
+    parser.add_argument("--record-oracles", action="store_true")
+    args = parser.parse_args()
+
+    if args.feed is None:
+        args.feed = write_fixture_feed(FIXTURE_FEED)
+
+    feed_name = os.path.basename(os.path.normpath(args.feed))
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    feed_baselines = baselines.setdefault(feed_name, {})
+    oracle_dir = os.path.join(ORACLE_DIR, feed_name)
+
+    if args.record_oracles:
+        warnings.filterwarnings("ignore")
+        for name in args.benchmarks or BENCHMARKS:
+            try:
+                expected = _record_oracle(name, args)
+            except SkipBenchmark as e:
+                print("{}: skipped, {}".format(name, e))
+                continue
+
+            os.makedirs(oracle_dir, exist_ok=True)
+            expected.to_csv(
+                os.path.join(oracle_dir, "{}.csv".format(name)), index=False
+            )
+            print("{}: oracle of {} recorded".format(name, feed_name))
+        return 0
+
+    failures = []
+    rows = []
+    # a fresh process per benchmark, so peak memory is that of the benchmark alone
+    context = multiprocessing.get_context("spawn")
+    for name in args.benchmarks or BENCHMARKS:
+        with context.Pool(1) as pool:
+            metrics, results = pool.apply(_run_benchmark, (name, args))
+
+        if results is None:
+            print("{}: skipped, {}".format(name, metrics))
+            continue
+
+        oracle_path = os.path.join(oracle_dir, "{}.csv".format(name))
+        if os.path.exists(oracle_path):
+            mismatch = _check_oracle(name, pd.read_csv(oracle_path, dtype=str), results)
+        else:
+            mismatch = "no oracle recorded, run with --record-oracles first"
+        if mismatch:
+            failures.append("{}: {}".format(name, mismatch))
+
+        if args.update_baselines:
+            feed_baselines[name] = metrics
+        else:
+            for metric in REGRESSION_METRICS:
+                baseline = feed_baselines.get(name, {}).get(metric)
+                if baseline and metrics[metric] > baseline * (1 + args.threshold):
+                    failures.append(
+                        "{}: {} of {:.4g} is {:.0%} above the baseline {:.4g}".format(
+                            name,
+                            metric,
+                            metrics[metric],
+                            metrics[metric] / baseline - 1,
+                            baseline,
+                        )
+                    )
+
+        rows.append(pd.Series(metrics, name=name))
+
+    if rows:
+        print(pd.DataFrame(rows).to_string(float_format="{:.4g}".format))
+
+    if args.update_baselines:
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print("Baselines of {} updated".format(feed_name))
+
+    for failure in failures:
+        print("FAILED {}".format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
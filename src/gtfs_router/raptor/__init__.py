@@ -1 +1,13 @@
+from .batch import batch_assignment, read_od_records
+from .compiled_feed import (
+    CompiledFeed,
+    compile_feed,
+    load_compiled_feed,
+    open_compiled_feed,
+)
+from .profile import raptor_profile
 from .raptor import raptor_assignment
+from .service_days import ServiceDayTimetables, service_ids_by_date
+from .skims import build_skims
+from .stats import QueryStats
+from .timetable import Timetable, compile_timetable
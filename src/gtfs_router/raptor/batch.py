@@ -0,0 +1,252 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router.raptor.raptor import raptor_assignment
+from gtfs_router.raptor.stats import QueryStats
+from gtfs_router.raptor.timetable import Timetable, compile_timetable
+
+logger = logging.getLogger(__name__)
+
+# Column names given to the leading columns of an OD file like data/matches.csv
+OD_COLUMNS = ["od_id", "from_stop_id", "to_stop_id"]
+
+RESULT_COLUMNS = ["arrival_time", "travel_time", "transfers", "legs"]
+
+# Default number of (origin, departure time) groups handed to a worker at a time
+DEFAULT_CHUNK_SIZE = 16
+
+# Timetable and settings shared by the queries run in a worker process
+_worker_state = {}
+
+
+def read_od_records(
+    path: str,
+    departure_time: Optional[float] = None,
+    time_column: Optional[str] = None,
+    time_scale: Optional[float] = 1,
+) -> pd.DataFrame:
+    """Read OD records from a CSV laid out like data/matches.csv.
+
+    The file holds no departure times of its own that can be relied on, so either a
+    departure time for every record or the name of the column holding them is
+    required.
+
+    :param path: Path to a CSV of (id, from stop, to stop, ...) records, with a
+        leading index column
+    :param departure_time: Departure time of every record, in seconds
+    :param time_column: Name of the column holding the departure time of each record
+    :param time_scale: Factor converting the times of the time_column to seconds
+    :return: The records with the OD_COLUMNS names and a departure_time column
+    """
+    if (departure_time is None) == (time_column is None):
+        raise ValueError("Either a departure_time or a time_column is required")
+
+    od_records = pd.read_csv(path, index_col=0, dtype=str)
+    if time_column is None:
+        departure_times = float(departure_time)
+    else:
+        departure_times = od_records[time_column].astype(float) * time_scale
+
+    od_records = od_records.iloc[:, : len(OD_COLUMNS)].set_axis(OD_COLUMNS, axis=1)
+    od_records["departure_time"] = departure_times
+
+    return od_records
+
+
+def _init_worker(
+    timetable: Timetable,
+    transfers: Optional[pd.DataFrame],
+    transfer_limit: int,
+    max_duration: Optional[float] = None,
+    collect_stats: Optional[bool] = False,
+    keep_rounds: Optional[bool] = False,
+):
+    _worker_state["timetable"] = timetable
+    _worker_state["transfers"] = transfers
+    _worker_state["transfer_limit"] = transfer_limit
+    _worker_state["max_duration"] = max_duration
+    _worker_state["collect_stats"] = collect_stats
+    _worker_state["keep_rounds"] = keep_rounds
+
+
+def _assign_group(group) -> Tuple[pd.DataFrame, Optional[QueryStats]]:
+    """Route every record of a single (origin, departure time) group."""
+    from_stop_id, departure_time, to_stop_ids, records = group
+    timetable = _worker_state["timetable"]
+    stats = QueryStats() if _worker_state["collect_stats"] else None
+    if stats is not None and _worker_state["keep_rounds"]:
+        stats.ended_rounds = []
+
+    # a single destination gets a pruned point-to-point query
+    to_stop_id = to_stop_ids[0] if len(set(to_stop_ids)) == 1 else None
+
+    unknown_stops = [
+        stop_id
+        for stop_id in [from_stop_id, to_stop_id]
+        if stop_id is not None and timetable.stop_index([stop_id])[0] < 0
+    ]
+    if unknown_stops:
+        logger.warning("No stop_id found for: {}".format(", ".join(unknown_stops)))
+        arrivals = np.full(len(records), np.nan)
+        legs = [[] for _ in records]
+    else:
+        stop_state = raptor_assignment(
+            None,
+            from_stop_id,
+            to_stop_id,
+            departure_time,
+            _worker_state["transfers"],
+            _worker_state["transfer_limit"],
+            timetable=timetable,
+            max_duration=_worker_state["max_duration"],
+            stats=stats,
+        )
+
+        reached = [stop_state.has_stop(stop_id) for stop_id in to_stop_ids]
+        arrivals = np.array(
+            [
+                (
+                    departure_time + stop_state.get_stop(stop_id)["time_to_reach"]
+                    if is_reached
+                    else np.nan
+                )
+                for stop_id, is_reached in zip(to_stop_ids, reached)
+            ]
+        )
+        legs = [
+            stop_state.get_legs(stop_id) if is_reached else []
+            for stop_id, is_reached in zip(to_stop_ids, reached)
+        ]
+
+    num_transit_legs = np.array(
+        [sum(1 for leg in record_legs if leg[0] == "transit") for record_legs in legs]
+    )
+
+    results = pd.DataFrame(
+        index=records,
+        data={
+            "arrival_time": arrivals,
+            "travel_time": arrivals - departure_time,
+            "transfers": np.where(
+                np.isnan(arrivals), np.nan, np.maximum(num_transit_legs - 1, 0)
+            ),
+            "legs": legs,
+        },
+    )
+
+    return results, stats
+
+
+def batch_assignment(
+    feed,
+    od_records: Union[pd.DataFrame, str],
+    transfers: Optional[pd.DataFrame],
+    transfer_limit: int,
+    timetable: Optional[Timetable] = None,
+    workers: Optional[int] = None,
+    chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    max_duration: Optional[float] = None,
+    stats: Optional[QueryStats] = None,
+    departure_time: Optional[float] = None,
+    time_column: Optional[str] = None,
+) -> pd.DataFrame:
+    """Route a batch of OD records across a pool of worker processes.
+
+    Records sharing an origin and departure time are answered by a single query, so
+    a one-to-all query serves every destination of the group. Each worker receives
+    the compiled timetable once, when it starts.
+
+    :param feed: A Partridge GTFS datafeed, only used if no timetable is given
+    :param od_records: Records with from_stop_id, to_stop_id and departure_time
+        (in seconds) columns, or the path to a CSV laid out like data/matches.csv,
+        read with read_od_records
+    :param transfers: Footpaths between stops, None for those of the timetable. The
+        table is sent to each worker along with the timetable, which is left as is.
+    :param transfer_limit: Maximum number of transfers between trips
+    :param timetable: A Timetable compiled from the feed. A timetable mapped with
+        load_compiled_feed(directory, mmap_mode="r") is shared by the workers instead
+        of being copied to each of them.
+    :param workers: Number of worker processes, defaults to the number of CPUs. With
+        a single worker the records are routed in this process.
+    :param chunk_size: Number of (origin, departure time) groups sent to a worker
+        at a time
+    :param max_duration: Query horizon, in seconds
+    :param stats: The per-round counters of every query, collected in the workers,
+        are added to it, and the rounds passed to its callback as each group of
+        records is merged
+    :param departure_time: Departure time of every record of a CSV, in seconds
+    :param time_column: Name of the column holding the departure times, in seconds,
+        of a CSV. A CSV needs either this or a departure_time.
+    :return: The records with arrival_time, travel_time (both in seconds), transfers
+        and legs columns added. Legs are (mode, from_stop_id, to_stop_id, trip_id).
+    """
+    tic = time.perf_counter()
+
+    if isinstance(od_records, str):
+        od_records = read_od_records(od_records, departure_time, time_column)
+
+    if timetable is None:
+        timetable = compile_timetable(feed, transfers)
+        transfers = None
+
+    groups = [
+        (
+            from_stop_id,
+            departure_time,
+            od_records["to_stop_id"].values[idx],
+            od_records.index[idx],
+        )
+        for (from_stop_id, departure_time), idx in od_records.groupby(
+            ["from_stop_id", "departure_time"], sort=False
+        ).indices.items()
+    ]
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    worker_args = (
+        timetable,
+        transfers,
+        transfer_limit,
+        max_duration,
+        stats is not None,
+        stats is not None and stats.callback is not None,
+    )
+    results = []
+    if workers == 1:
+        _init_worker(*worker_args)
+        for group in groups:
+            results.append(_assign_group(group))
+            if stats is not None:
+                stats.merge(results[-1][1])
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=worker_args
+        ) as executor:
+            for group_results, group_stats in executor.map(
+                _assign_group, groups, chunksize=chunk_size
+            ):
+                results.append((group_results, group_stats))
+                if stats is not None:
+                    stats.merge(group_stats)
+
+    toc = time.perf_counter()
+    logger.info(
+        "{} OD records in {} groups routed in {:0.4f} seconds".format(
+            len(od_records), len(groups), toc - tic
+        )
+    )
+
+    if not results:
+        return od_records.assign(
+            **{col: pd.Series(dtype=object) for col in RESULT_COLUMNS}
+        )
+
+    results = pd.concat([group_results for group_results, _ in results])
+    return od_records.join(results[RESULT_COLUMNS])
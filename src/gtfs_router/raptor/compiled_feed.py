@@ -0,0 +1,316 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router import ALBERS_EQUAL_AREA_CONICAL_EPSG
+from gtfs_router.raptor.timetable import Timetable, compile_timetable
+from gtfs_router.utils.ids import FeedIds, IdMap, intern_feed_ids
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of a compiled feed changes, so older layouts are rebuilt
+LAYOUT_VERSION = 1
+
+MANIFEST = "manifest.json"
+SOURCES = "sources.json"
+
+TIMETABLE_ARRAYS = [
+    "trip_routes",
+    "route_stop_offsets",
+    "route_stops",
+    "route_trip_offsets",
+    "route_trips",
+    "route_time_offsets",
+    "arrivals",
+    "departures",
+    "stop_route_offsets",
+    "stop_routes",
+    "stop_route_positions",
+]
+FOOTPATH_ARRAYS = ["footpath_offsets", "footpath_stops", "footpath_walk_times"]
+
+# Size of the blocks the source files are read in while hashing
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+class CompiledFeed:
+    def __init__(
+        self,
+        directory: str,
+        timetable: Timetable,
+        stop_coords: np.ndarray,
+        epsg: int,
+        feed_hash: str,
+    ):
+        """The routing structures of a feed, read back from a compiled directory.
+
+        :param directory: The compiled directory the feed was read from
+        :param timetable: The compiled timetable, with the footpaths of the feed
+        :param stop_coords: (stops x 2) projected coordinates of every timetable stop,
+            NaN for stops missing from stops.txt
+        :param epsg: Projection of the stop coordinates
+        :param feed_hash: Content hash of the source files and compile settings
+        """
+        self.directory = directory
+        self.timetable = timetable
+        self.stop_coords = stop_coords
+        self.epsg = epsg
+        self.feed_hash = feed_hash
+
+
+def _source_files(path: str) -> List[str]:
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(path, name)
+            for name in os.listdir(path)
+            if name.endswith(".txt")
+        )
+    return [path]
+
+
+def _source_hash(path: str, output_dir: str) -> str:
+    """Content hash of the GTFS files at a path, a directory or a zip file.
+
+    Hashing a large stop_times.txt takes a while, so the hash is stored alongside the
+    size and modification time of every file, and only recomputed when they change.
+    """
+    signature = [
+        [os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns]
+        for f in _source_files(path)
+    ]
+
+    sources_path = os.path.join(output_dir, SOURCES)
+    sources = {}
+    if os.path.exists(sources_path):
+        with open(sources_path) as f:
+            sources = json.load(f)
+    key = os.path.abspath(path)
+    if key in sources and sources[key]["signature"] == signature:
+        return sources[key]["hash"]
+
+    digest = hashlib.sha1()
+    for source in _source_files(path):
+        digest.update(os.path.basename(source).encode())
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+
+    sources[key] = {"signature": signature, "hash": digest.hexdigest()}
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".json.tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(sources, f)
+    os.replace(tmp_path, sources_path)
+
+    return sources[key]["hash"]
+
+
+def _view_key(view: Optional[Dict]) -> list:
+    """A stable description of a partridge view, whatever the types of its values."""
+    if not view:
+        return []
+
+    key = []
+    for file_name in sorted(view):
+        for column, values in sorted(view[file_name].items()):
+            if isinstance(values, str):
+                values = [values]
+            key.append([file_name, column, sorted(str(value) for value in values)])
+    return key
+
+
+def _feed_hash(
+    path: str,
+    output_dir: str,
+    view: Optional[Dict],
+    transfers: Optional[pd.DataFrame],
+    epsg: int,
+) -> str:
+    digest = hashlib.sha1(
+        json.dumps(
+            [LAYOUT_VERSION, _source_hash(path, output_dir), _view_key(view), epsg]
+        ).encode()
+    )
+    if transfers is not None:
+        digest.update(
+            pd.util.hash_pandas_object(
+                transfers.reindex(
+                    columns=["from_stop_id", "to_stop_id", "min_transfer_time"]
+                ),
+                index=False,
+            ).values.tobytes()
+        )
+    return digest.hexdigest()
+
+
+def _project_stops(feed, ids: FeedIds, epsg: int) -> np.ndarray:
+    import pyproj
+
+    stops = feed.stops.drop_duplicates("stop_id")
+    codes = ids.stops.codes(stops["stop_id"])
+    x, y = pyproj.Transformer.from_crs(
+        pyproj.CRS("EPSG:4326"), pyproj.CRS.from_epsg(epsg), always_xy=True
+    ).transform(
+        pd.to_numeric(stops["stop_lon"]).to_numpy(dtype=float),
+        pd.to_numeric(stops["stop_lat"]).to_numpy(dtype=float),
+    )
+
+    stop_coords = np.full((len(ids.stops), 2), np.nan)
+    stop_coords[codes[codes >= 0]] = np.column_stack([x, y])[codes >= 0]
+    return stop_coords
+
+
+def compile_feed(
+    path: str,
+    output_dir: Optional[str] = None,
+    view: Optional[Dict] = None,
+    transfers: Optional[pd.DataFrame] = None,
+    epsg: Optional[int] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
+) -> str:
+    """Compile a GTFS feed into a directory of .npy arrays, keyed by its content hash.
+
+    The interned ids, the route patterns and their sorted stop times, the footpath
+    adjacency and the projected stop coordinates are written to
+    output_dir/{hash}, where the hash covers the source files, the view, the transfers
+    and the epsg. If that directory already exists the feed is not compiled again.
+
+    :param path: Path to the GTFS feed, a directory or a zip file
+    :param output_dir: Directory the compiled feeds are kept in, defaults to the path
+        with a .compiled suffix
+    :param view: A partridge view applied when reading the feed, such as the trips of
+        the service_ids of a date
+    :param transfers: Footpaths between stops, defaults to the transfers of the feed
+    :param epsg: Projection of the stop coordinates
+    :return: The compiled directory
+    """
+    import partridge as ptg
+
+    if output_dir is None:
+        output_dir = os.path.normpath(path) + ".compiled"
+    os.makedirs(output_dir, exist_ok=True)
+
+    feed_hash = _feed_hash(path, output_dir, view, transfers, epsg)
+    directory = os.path.join(output_dir, feed_hash)
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        logger.debug("Feed {} is already compiled in {}".format(path, directory))
+        return directory
+
+    tic = time.perf_counter()
+
+    feed = ptg.load_feed(path, view)
+    ids = intern_feed_ids(feed)
+    timetable = compile_timetable(feed, transfers, ids=ids)
+    footpaths = timetable.footpaths(None)
+
+    arrays = {name: getattr(timetable, name) for name in TIMETABLE_ARRAYS}
+    arrays.update(zip(FOOTPATH_ARRAYS, footpaths))
+    arrays.update(
+        {
+            "stop_ids": ids.stops.ids.astype(str),
+            "trip_ids": ids.trips.ids.astype(str),
+            "route_ids": ids.routes.ids.astype(str),
+            "stop_coords": _project_stops(feed, ids, epsg),
+        }
+    )
+
+    # written to a temporary directory first, so readers never see a partial feed
+    tmp_dir = tempfile.mkdtemp(dir=output_dir, suffix=".tmp")
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, "{}.npy".format(name)), values)
+    with open(os.path.join(tmp_dir, MANIFEST), "w") as f:
+        json.dump(
+            {
+                "layout_version": LAYOUT_VERSION,
+                "hash": feed_hash,
+                "source": os.path.abspath(path),
+                "epsg": epsg,
+                "arrays": sorted(arrays),
+            },
+            f,
+            indent=2,
+        )
+    try:
+        os.replace(tmp_dir, directory)
+    except OSError:
+        # another process compiled the same feed first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    toc = time.perf_counter()
+    logger.info("Feed {} compiled in {:0.4f} seconds".format(path, toc - tic))
+
+    return directory
+
+
+def load_compiled_feed(directory: str, mmap_mode: Optional[str] = None) -> CompiledFeed:
+    """Read a feed written by compile_feed.
+
+    :param directory: The compiled directory returned by compile_feed
+    :param mmap_mode: 'r' to memory-map the arrays read-only instead of reading them.
+        Processes mapping the same directory share its pages, and a mapped timetable
+        is pickled as a reference to the directory.
+    :return: The compiled feed
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest["layout_version"] != LAYOUT_VERSION:
+        raise ValueError(
+            "{} was compiled with layout version {}, expected {}".format(
+                directory, manifest["layout_version"], LAYOUT_VERSION
+            )
+        )
+
+    # plain ndarray views of the maps, which are cheaper to slice in the scans
+    arrays = {
+        name: np.asarray(
+            np.load(os.path.join(directory, "{}.npy".format(name)), mmap_mode=mmap_mode)
+        )
+        for name in manifest["arrays"]
+    }
+    ids = FeedIds(
+        stops=IdMap(arrays["stop_ids"].astype(object)),
+        trips=IdMap(arrays["trip_ids"].astype(object)),
+        routes=IdMap(arrays["route_ids"].astype(object)),
+    )
+    timetable = Timetable(
+        ids=ids,
+        footpaths=tuple(arrays[name] for name in FOOTPATH_ARRAYS),
+        mapped_from=None if mmap_mode is None else os.path.abspath(directory),
+        **{name: arrays[name] for name in TIMETABLE_ARRAYS},
+    )
+
+    return CompiledFeed(
+        directory=directory,
+        timetable=timetable,
+        stop_coords=arrays["stop_coords"],
+        epsg=manifest["epsg"],
+        feed_hash=manifest["hash"],
+    )
+
+
+def _open_mapped_timetable(directory: str) -> Timetable:
+    """Map the timetable of a compiled directory, used to unpickle mapped timetables."""
+    return load_compiled_feed(directory, mmap_mode="r").timetable
+
+
+def open_compiled_feed(
+    path: str,
+    output_dir: Optional[str] = None,
+    view: Optional[Dict] = None,
+    transfers: Optional[pd.DataFrame] = None,
+    epsg: Optional[int] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
+    mmap_mode: Optional[str] = None,
+) -> CompiledFeed:
+    """Load the compiled feed of a GTFS feed, compiling it first if the feed changed.
+
+    Takes the arguments of compile_feed, and the mmap_mode of load_compiled_feed.
+    """
+    return load_compiled_feed(
+        compile_feed(path, output_dir, view, transfers, epsg), mmap_mode=mmap_mode
+    )
@@ -0,0 +1,202 @@
+import logging
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router.raptor.raptor import StopAccessState, _scan_route
+from gtfs_router.raptor.timetable import Timetable, compile_timetable, footpaths_from
+
+logger = logging.getLogger(__name__)
+
+
+def _departures_in_window(
+    timetable: Timetable,
+    access_stops: np.ndarray,
+    access_times: np.ndarray,
+    earliest_departure: float,
+    latest_departure: float,
+) -> np.ndarray:
+    """Times the origin can be left to catch a trip at one of the access stops."""
+    departures = []
+    for stop, access_time in zip(access_stops, access_times):
+        start = timetable.stop_route_offsets[stop]
+        end = timetable.stop_route_offsets[stop + 1]
+        for route, position in zip(
+            timetable.stop_routes[start:end], timetable.stop_route_positions[start:end]
+        ):
+            departures.append(timetable.route_times(route)[1][position] - access_time)
+
+    if not departures:
+        return np.empty(0)
+
+    departures = np.unique(np.concatenate(departures))
+    in_window = (departures >= earliest_departure) & (departures <= latest_departure)
+    return departures[in_window][::-1]
+
+
+def _improve(arrivals: np.ndarray, stops: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """Apply the earliest time offered to each stop if it improves the label."""
+    idx = StopAccessState._earliest_per_stop(stops, times)
+    idx = idx[times[idx] < arrivals[stops[idx]]]
+    arrivals[stops[idx]] = times[idx]
+    return stops[idx]
+
+
+def raptor_profile(
+    feed,
+    from_stop_id: str,
+    earliest_departure: float,
+    latest_departure: float,
+    transfers: pd.DataFrame,
+    transfer_limit: int,
+    timetable: Optional[Timetable] = None,
+) -> pd.DataFrame:
+    """Find the best journeys from a stop for every departure in a time window.
+
+    Runs Range RAPTOR (rRAPTOR): each departure time at which a trip can be caught
+    is processed from latest to earliest, and the per-round labels of later
+    departures are kept as upper bounds for earlier ones, so each run only explores
+    the journeys that a later departure cannot match.
+
+    :param feed: A Partridge GTFS datafeed
+    :param from_stop_id: The origin stop
+    :param earliest_departure: Start of the departure window, in seconds
+    :param latest_departure: End of the departure window, in seconds
+    :param transfers: Footpaths between stops
+    :param transfer_limit: Maximum number of transfers between trips
+    :param timetable: A Timetable compiled from the feed
+    :return: The Pareto set of (departure_time, arrival_time, transfers) for each
+        stop reached, where no other journey leaves later, arrives earlier and
+        uses no more transfers. Walking there from the origin is a journey with
+        no transfer, like riding a single trip.
+    """
+    tic = time.perf_counter()
+
+    if timetable is None:
+        timetable = compile_timetable(feed, transfers)
+
+    origin = timetable.stop_index([from_stop_id])[0]
+    if origin < 0:
+        raise KeyError("No stop_id found for: {}".format(from_stop_id))
+
+    # stops that can be walked to from the origin before boarding the first trip
+    footpaths = timetable.footpaths(transfers)
+    _, to_stops, walk_times = footpaths_from(footpaths, np.array([origin]))
+    access_stops = np.r_[origin, to_stops].astype(np.int32)
+    access_times = np.r_[0.0, walk_times]
+
+    departures = _departures_in_window(
+        timetable, access_stops, access_times, earliest_departure, latest_departure
+    )
+
+    # arrivals[k] is the earliest arrival using at most k trips, for any of the
+    # departures processed so far, and transit_arrivals[k] the earliest by trip
+    arrivals = np.full((transfer_limit + 2, timetable.num_stops), np.inf)
+    transit_arrivals = arrivals.copy()
+
+    journeys = []
+    for departure in departures:
+        just_updated_stops = _improve(
+            arrivals[0], access_stops, departure + access_times
+        )
+
+        # walking from the origin has no transfer, like riding a single trip, so it
+        # is only a journey when no later departure rides a trip there sooner
+        walked_stops = just_updated_stops[
+            (just_updated_stops != origin)
+            & (arrivals[0, just_updated_stops] < arrivals[1, just_updated_stops])
+        ]
+        journeys.append(
+            (
+                walked_stops,
+                np.full(len(walked_stops), departure),
+                arrivals[0, walked_stops],
+                np.zeros(len(walked_stops), dtype=int),
+            )
+        )
+
+        for k in range(1, transfer_limit + 2):
+            arrivals[k] = np.minimum(arrivals[k], arrivals[k - 1])
+            transit_arrivals[k] = np.minimum(
+                transit_arrivals[k], transit_arrivals[k - 1]
+            )
+
+            routes, starts = timetable.routes_serving(just_updated_stops)
+            if len(routes) == 0:
+                break
+
+            results = [
+                _scan_route(
+                    timetable, route, start, arrivals[k - 1], transit_arrivals[k]
+                )
+                for route, start in zip(routes, starts)
+            ]
+            arrive_stops, arrive_times = (
+                np.concatenate(x) for x in list(zip(*results))[:2]
+            )
+            transit_updated_stops = _improve(
+                transit_arrivals[k], arrive_stops, arrive_times
+            )
+            if len(transit_updated_stops) == 0:
+                break
+
+            from_stops, to_stops, walk_times = footpaths_from(
+                footpaths, transit_updated_stops
+            )
+            updated_stops = np.union1d(
+                _improve(
+                    arrivals[k],
+                    transit_updated_stops,
+                    transit_arrivals[k, transit_updated_stops],
+                ),
+                _improve(
+                    arrivals[k],
+                    to_stops,
+                    transit_arrivals[k, from_stops] + walk_times,
+                ),
+            )
+
+            journeys.append(
+                (
+                    updated_stops,
+                    np.full(len(updated_stops), departure),
+                    arrivals[k, updated_stops],
+                    np.full(len(updated_stops), k - 1),
+                )
+            )
+            just_updated_stops = np.union1d(transit_updated_stops, updated_stops)
+
+    toc = time.perf_counter()
+    logger.debug(
+        "Profile of {} departures calculated in {:0.4f} seconds".format(
+            len(departures), toc - tic
+        )
+    )
+
+    columns = ["to_stop_id", "departure_time", "arrival_time", "transfers"]
+    if not journeys:
+        return pd.DataFrame(columns=columns)
+
+    to_stops, departure_times, arrival_times, num_transfers = (
+        np.concatenate(x) for x in zip(*journeys)
+    )
+    journeys = pd.DataFrame(
+        {
+            "to_stop_id": timetable.stop_ids[to_stops],
+            "departure_time": departure_times,
+            "arrival_time": arrival_times,
+            "transfers": num_transfers,
+        },
+        columns=columns,
+    )
+
+    # a trip beating the walk from the same departure replaces it
+    return (
+        journeys.sort_values(
+            ["to_stop_id", "departure_time", "transfers", "arrival_time"]
+        )
+        .drop_duplicates(["to_stop_id", "departure_time", "transfers"])
+        .reset_index(drop=True)
+    )
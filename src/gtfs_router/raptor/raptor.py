@@ -1,282 +1,581 @@
 import logging
 import time
-from typing import List, Optional, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
-import pyproj
-from shapely.geometry import LineString
-from shapely.ops import transform
 
 from gtfs_router import ALBERS_EQUAL_AREA_CONICAL_EPSG
-from gtfs_router.utils import line_cutter
+from gtfs_router.raptor.stats import QueryStats
+from gtfs_router.raptor.timetable import Timetable, compile_timetable, footpaths_from
+from gtfs_router.utils.feed_index import feed_index
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logging.debug("tests")
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+logger = logging.getLogger(__name__)
+
+
+# Leg types of the parent pointers kept by StopAccessState
+NOT_REACHED = -1
+ORIGIN = 0
+TRANSIT = 1
+WALK = 2
 
 
 class StopAccessState:
-    def __init__(self, origin_stop_id: str, gtfs_feed):
-        """State tracker for stop ids."""
-        self._stops = {}
+    def __init__(
+        self,
+        origin_stop_id: str,
+        gtfs_feed,
+        timetable: Timetable,
+        departure_time: float,
+        transfer_limit: int,
+        max_duration: Optional[float] = None,
+    ):
+        """State tracker for stop ids.
 
-        # initialize the origin node with no prior trip history
-        self._origin = origin_stop_id
+        Labels are kept in arrays indexed by timetable stop index, with one row per
+        RAPTOR round. Round k holds the stops improved using k trips, along with a
+        parent pointer (leg type, boarding stop, trip, walk origin) describing the last
+        leg taken, so journeys are only rebuilt when asked for. Transit legs also keep
+        the positions along the route they were boarded and alighted at, which tell
+        the visits of a loop route to the same stop apart.
+
+        The best arrival by trip is tracked apart from the best arrival overall, so a
+        stop first reached on foot can still be walked away from after a trip.
+
+        With a max_duration, no stop is labelled later than departure_time +
+        max_duration, the query horizon.
+        """
         self._gtfs_feed = gtfs_feed
-        self.try_add_update(self._origin, 0)
+        self._timetable = timetable
+        self._departure_time = departure_time
+        self._latest_arrival = (
+            np.inf if max_duration is None else departure_time + max_duration
+        )
+
+        num_rounds = transfer_limit + 2
+        num_stops = timetable.num_stops
+
+        # tau_k, the arrival time at each stop improved in round k, and tau*
+        self._arrivals = np.full((num_rounds, num_stops), np.inf)
+        self._best = np.full(num_stops, np.inf)
+        self._best_transit = np.full(num_stops, np.inf)
+
+        # arrival by trip, and departure of that trip from its boarding stop
+        self._transit_arrivals = np.full((num_rounds, num_stops), np.inf)
+        self._board_times = np.full((num_rounds, num_stops), np.inf)
+
+        self._leg_type = np.full((num_rounds, num_stops), NOT_REACHED, dtype=np.int8)
+        self._board_stop = np.full((num_rounds, num_stops), -1, dtype=np.int32)
+        self._trip = np.full((num_rounds, num_stops), -1, dtype=np.int32)
+        self._board_position = np.full((num_rounds, num_stops), -1, dtype=np.int32)
+        self._alight_position = np.full((num_rounds, num_stops), -1, dtype=np.int32)
+        self._walk_from = np.full((num_rounds, num_stops), -1, dtype=np.int32)
+
+        # initialize the origin node with no prior trip history
+        self._origin = timetable.stop_index([origin_stop_id])[0]
+        if self._origin < 0:
+            raise KeyError("No stop_id found for: {}".format(origin_stop_id))
+
+        self._arrivals[0, self._origin] = departure_time
+        self._best[self._origin] = departure_time
+        self._leg_type[0, self._origin] = ORIGIN
+
+    @property
+    def latest_arrival(self) -> float:
+        return self._latest_arrival
+
+    @property
+    def best_arrivals(self) -> np.ndarray:
+        return self._best
+
+    @property
+    def best_transit_arrivals(self) -> np.ndarray:
+        return self._best_transit
+
+    def arrivals_in_round(self, k: int) -> np.ndarray:
+        return self._arrivals[k]
 
     def all_stops(self):
-        return list(self._stops.keys())
+        return list(self._timetable.stop_ids[np.isfinite(self._best)])
 
     def has_stop(self, stop_id: str):
-        return stop_id in self._stops.keys()
+        stop = self._timetable.stop_index([stop_id])[0]
+        return stop >= 0 and np.isfinite(self._best[stop])
 
     def get_stop(self, stop_id: str):
-        return self._stops[stop_id]
+        if not self.has_stop(stop_id):
+            raise KeyError(stop_id)
+
+        stop = self._timetable.stop_index([stop_id])[0]
+        return {
+            "time_to_reach": self._best[stop] - self._departure_time,
+            "preceding": [
+                self._timetable.trip_ids[trip]
+                for leg_type, _, _, trip, _, _ in self._path(stop)
+                if leg_type == TRANSIT
+            ],
+        }
+
+    def get_legs(self, stop_id: str) -> List[Tuple[str, str, str, Optional[str]]]:
+        """Legs taken to reach a stop, as (mode, from_stop_id, to_stop_id, trip_id)."""
+        if not self.has_stop(stop_id):
+            raise KeyError(stop_id)
+
+        return self._leg_ids(self._path(self._timetable.stop_index([stop_id])[0]))
+
+    def pareto(self, to_stop_id: str) -> List[Tuple[int, float, List[Tuple]]]:
+        """Trade-off between arrival time and number of transfers at a stop.
+
+        Round k holds the earliest arrival using k trips whenever it beats every
+        journey with fewer trips, so a single run yields the whole Pareto front.
+
+        :param to_stop_id: The destination stop
+        :return: (transfers, arrival_time, legs) for each Pareto-optimal journey, by
+            increasing number of transfers. Legs are as returned by get_legs.
+        """
+        if not self.has_stop(to_stop_id):
+            raise KeyError(to_stop_id)
+
+        stop = self._timetable.stop_index([to_stop_id])[0]
+        front = []
+        for k in np.flatnonzero(self._leg_type[:, stop] != NOT_REACHED):
+            transfers = max(int(k) - 1, 0)
+
+            # walking from the origin and riding a single trip both have no transfer
+            if front and front[-1][0] == transfers:
+                front.pop()
+
+            front.append(
+                (
+                    transfers,
+                    float(self._arrivals[k, stop]),
+                    self._leg_ids(self._path(stop, k)),
+                )
+            )
+
+        return front
+
+    def _leg_ids(self, legs: List[Tuple[int, ...]]) -> List[Tuple]:
+        """Translate the legs of a path to (mode, from_stop_id, to_stop_id, trip_id)."""
+        stop_ids = self._timetable.stop_ids
+        trip_ids = self._timetable.trip_ids
+        return [
+            (
+                "transit" if leg_type == TRANSIT else "walk",
+                stop_ids[from_stop],
+                stop_ids[to_stop],
+                trip_ids[trip] if leg_type == TRANSIT else None,
+            )
+            for leg_type, from_stop, to_stop, trip, _, _ in legs
+        ]
 
     def get_stops(self, stop_ids: List[str]):
-        return {stop_id: self._stops[stop_id] for stop_id in stop_ids}
+        return {stop_id: self.get_stop(stop_id) for stop_id in stop_ids}
 
     def get_preceding_trips(self, stop_ids: List[str]):
         return [
             (stop_id, preceding)
             for stop_id in stop_ids
-            for preceding in self._stops[stop_id]["preceding"]
+            for preceding in self.get_stop(stop_id)["preceding"]
         ]
 
-    def try_add_update(
-        self,
-        stop_id: str,
-        time_to_reach: Union[int, float],
-        trip_id: Optional[str] = None,
-        preceding_stop: Optional[str] = None,
-        preceding_path: Optional[List[str]] = None,
-        k: Optional[int] = None,
-    ) -> bool:
-        # initialize return object
-        did_update = False
-
-        if stop_id in self._stops.keys():
-            if self._stops[stop_id]["time_to_reach"] > time_to_reach:
-                # update the stop access attributes
-                self._stops[stop_id]["time_to_reach"] = time_to_reach
-                did_update = True
-        else:
-            self._stops[stop_id] = {
-                "time_to_reach": time_to_reach,
-                "preceding": [trip_id] if trip_id else [],
-                "trip_path": {},
-                "stop_path": {},
-            }
-            did_update = True
-
-        if did_update:
-            if not k is None:
-                self._stops[stop_id]["prior_segment"] = {
-                    "segment_num": k,
-                    "trip_id": trip_id if k % 2 == 0 else "walk transfer",
-                    "from_stop_id": preceding_stop,
-                }
-
-            # override if a preceding path is provided
-            if preceding_path:
-                self._stops[stop_id]["preceding"] = preceding_path.copy()
-
-            # add current trip id to the path of trips taken, avoiding dupes
-            if trip_id is not None:
-                if len(self._stops[stop_id]["preceding"]) == 0:
-                    self._stops[stop_id]["preceding"] = [trip_id]
-                elif trip_id != self._stops[stop_id]["preceding"][-1]:
-                    self._stops[stop_id]["preceding"] = self._stops[stop_id][
-                        "preceding"
-                    ].copy() + [trip_id]
-
-        return did_update
-
-    def _get_trip_segment(
+    @staticmethod
+    def _earliest_per_stop(stops: np.ndarray, times: np.ndarray) -> np.ndarray:
+        """Positions of the earliest time offered for each distinct stop."""
+        order = np.lexsort((times, stops))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = stops[order][1:] != stops[order][:-1]
+        return order[first]
+
+    def try_add_transit(
         self,
-        prior_stop_mp,
-        current_stop_mp,
-        current_trip_id,
-        epsg=ALBERS_EQUAL_AREA_CONICAL_EPSG,
-    ):
-        stops = self._gtfs_feed.stops
-        # prior_stop = stops[stops['stop_id'] == prior_stop_id].values[0]
-        # current_stop = stops[stops['stop_id'] == current_stop_id].values[0]
-
-        trips = self._gtfs_feed.trips
-        shape_id = trips[trips["trip_id"] == current_trip_id]["shape_id"].values[0]
-
-        shapes = self._gtfs_feed.shapes.to_crs(epsg=epsg)
-        route_shape = shapes[shapes["shape_id"] == shape_id]["geometry"].values[0]
-
-        line = line_cutter(route_shape, prior_stop_mp)[-1]
-        line = line_cutter(line, current_stop_mp - prior_stop_mp)[0]
+        k: int,
+        stops: np.ndarray,
+        times: np.ndarray,
+        trips: np.ndarray,
+        board_stops: np.ndarray,
+        board_times: np.ndarray,
+        board_positions: np.ndarray,
+        alight_positions: np.ndarray,
+    ) -> np.ndarray:
+        """Add arrivals by trip in round k, returning the stops that improved.
+
+        A stop improves when it is reached by trip earlier than before, even if it can
+        be reached earlier still on foot. Positions are the stop positions along the
+        route of the trip.
+        """
+        idx = self._earliest_per_stop(stops, times)
+        idx = idx[times[idx] < self._best_transit[stops[idx]]]
+        improved = stops[idx]
+
+        self._best_transit[improved] = times[idx]
+        self._transit_arrivals[k, improved] = times[idx]
+        self._board_times[k, improved] = board_times[idx]
+        self._board_stop[k, improved] = board_stops[idx]
+        self._trip[k, improved] = trips[idx]
+        self._board_position[k, improved] = board_positions[idx]
+        self._alight_position[k, improved] = alight_positions[idx]
+
+        is_best = times[idx] < self._best[improved]
+        idx = idx[is_best]
+        self._arrivals[k, improved[is_best]] = times[idx]
+        self._best[improved[is_best]] = times[idx]
+        self._leg_type[k, improved[is_best]] = TRANSIT
+
+        return improved
+
+    def try_add_walk(
+        self, k: int, stops: np.ndarray, times: np.ndarray, from_stops: np.ndarray
+    ) -> np.ndarray:
+        """Add arrivals by footpath in round k, returning the stops that improved."""
+        idx = self._earliest_per_stop(stops, times)
+        idx = idx[times[idx] < self._best[stops[idx]]]
+        improved = stops[idx]
+
+        # The transit pointer of the stop is kept, as other footpaths in this round
+        # may start from the trip arriving there
+        self._arrivals[k, improved] = times[idx]
+        self._best[improved] = times[idx]
+        self._leg_type[k, improved] = WALK
+        self._walk_from[k, improved] = from_stops[idx]
+
+        return improved
+
+    def _last_round(self, stop: int, k: Optional[int] = None) -> int:
+        """The latest round, up to k, in which the stop was improved."""
+        if k is None:
+            k = self._leg_type.shape[0] - 1
+
+        rounds = np.flatnonzero(self._leg_type[: k + 1, stop] != NOT_REACHED)
+        if len(rounds) == 0:
+            raise KeyError(self._timetable.stop_ids[stop])
+        return rounds[-1]
+
+    def _path(self, stop: int, k: Optional[int] = None) -> List[Tuple[int, ...]]:
+        """Rebuild the legs taken to a stop.
+
+        Legs are (leg type, from stop, to stop, trip, board position, alight
+        position), with -1 for the trip and positions of walks.
+        """
+        legs = []
+        k = self._last_round(stop, k)
+
+        while self._leg_type[k, stop] != ORIGIN:
+            if self._leg_type[k, stop] == WALK:
+                from_stop = self._walk_from[k, stop]
+                legs.append((WALK, from_stop, stop, -1, -1, -1))
+
+                # footpaths always start from the stop a trip arrived at this round
+                stop = from_stop
+                if k == 0:
+                    break
+
+            from_stop = self._board_stop[k, stop]
+            legs.append(
+                (
+                    TRANSIT,
+                    from_stop,
+                    stop,
+                    self._trip[k, stop],
+                    self._board_position[k, stop],
+                    self._alight_position[k, stop],
+                )
+            )
 
-        from_proj = pyproj.CRS("EPSG:5070")
-        to_proj = pyproj.CRS("EPSG:4326")
+            stop = from_stop
+            k = self._last_round(stop, k - 1)
 
-        project = pyproj.Transformer.from_crs(
-            from_proj, to_proj, always_xy=True
-        ).transform
-        return transform(project, line)
+        return legs[::-1]
 
-    def describe_path(
-        self, to_stop_id: str, epsg: Optional[int] = ALBERS_EQUAL_AREA_CONICAL_EPSG
-    ) -> List[str]:
-        stops = self._gtfs_feed.stops
-        stop_times = self._gtfs_feed.stop_times
-        trips = self._gtfs_feed.trips
-        routes = self._gtfs_feed.routes
-
-        current_stop_id = to_stop_id
-        current_stop = self.get_stop(to_stop_id)
-        max_segment_num = current_stop["prior_segment"]["segment_num"]
-
-        out_messages = {}
-        segments = {}
-        from_stop = {}
-        from_name = {}
-        from_stop_lat = {}
-        from_stop_lon = {}
-        to_stop = {}
-        to_name = {}
-        to_stop_lat = {}
-        to_stop_lon = {}
-        mode = {}
-        color = {}
-
-        for x in range(max_segment_num, -1, -1):
-            if "prior_segment" not in current_stop or current_stop["prior_segment"]["segment_num"] != x:
-                continue
+    def _last_rounds(self, stops: np.ndarray, k: np.ndarray) -> np.ndarray:
+        """Vectorized _last_round for arrays of stops and rounds."""
+        rounds = np.arange(self._leg_type.shape[0])[:, None]
+        is_improved = (self._leg_type[:, stops] != NOT_REACHED) & (rounds <= k)
+        return rounds.shape[0] - 1 - np.argmax(is_improved[::-1], axis=0)
 
-            prior_stop_id = current_stop["prior_segment"]["from_stop_id"]
-            prior_stop = self.get_stop(prior_stop_id)
+    def travel_time_components(
+        self, stop_ids: Optional[List[str]] = None
+    ) -> Dict[str, np.ndarray]:
+        """Split the journeys to many stops into travel time components at once.
 
-            current_stop_row = stops[stops["stop_id"] == current_stop_id].iloc[0].squeeze()
-            prior_stop_row = stops[stops["stop_id"] == prior_stop_id].iloc[0].squeeze()
+        The parent pointers of every stop are followed back to the origin together,
+        one leg per step. Wait time includes the initial wait at the origin, so the
+        travel time is the sum of the in-vehicle, wait and walk times.
 
-            current_stop_name = current_stop_row["stop_name"]
-            prior_stop_name = prior_stop_row["stop_name"]
+        :param stop_ids: The stops to reach, defaults to all stops of the timetable
+        :return: Arrays of travel_time, in_vehicle_time, wait_time, walk_time and
+            boardings, aligned with the stops. Unreached stops get NaN.
+        """
+        if stop_ids is None:
+            stops = np.arange(self._timetable.num_stops, dtype=np.int32)
+        else:
+            stops = self._timetable.stop_index(stop_ids)
 
-            current_trip_id = current_stop["prior_segment"]["trip_id"]
+        is_reached = stops >= 0
+        is_reached[is_reached] = np.isfinite(self._best[stops[is_reached]])
 
-            from_stop[x] = prior_stop_id
-            to_stop[x] = current_stop_id
+        components = {
+            name: np.zeros(len(stops))
+            for name in ["in_vehicle_time", "wait_time", "walk_time", "boardings"]
+        }
 
-            from_name[x] = prior_stop_name
-            from_stop_lat[x] = prior_stop_row['geometry'].y
-            from_stop_lon[x] = prior_stop_row['geometry'].x
+        positions = np.flatnonzero(is_reached)
+        current = stops[positions]
+        k = self._last_rounds(current, np.full(len(current), self._leg_type.shape[0]))
+
+        while len(positions):
+            # walk legs, which start from the trip arriving in the same round
+            is_walk = self._leg_type[k, current] == WALK
+            walk_from = self._walk_from[k[is_walk], current[is_walk]]
+            left_at = np.where(
+                k[is_walk] == 0,
+                self._departure_time,
+                self._transit_arrivals[k[is_walk], walk_from],
+            )
+            components["walk_time"][positions[is_walk]] += (
+                self._arrivals[k[is_walk], current[is_walk]] - left_at
+            )
+            current[is_walk] = walk_from
 
-            to_name[x] = current_stop_name
-            to_stop_lat[x] = current_stop_row['geometry'].y
-            to_stop_lon[x] = current_stop_row['geometry'].x
+            is_done = (self._leg_type[k, current] == ORIGIN) | (is_walk & (k == 0))
+            positions, current, k = positions[~is_done], current[~is_done], k[~is_done]
 
-            if current_trip_id != "walk transfer":
-                route_id = trips[trips["trip_id"] == current_trip_id]["route_id"]
-                route_color = routes[routes["route_id"].isin(route_id)][
-                    "route_color"
-                ].values[0]
+            # transit legs, and the wait at the stop they were boarded at
+            board_stops = self._board_stop[k, current]
+            board_times = self._board_times[k, current]
+            components["in_vehicle_time"][positions] += (
+                self._transit_arrivals[k, current] - board_times
+            )
+            components["boardings"][positions] += 1
 
-                color[x] = "#" + route_color
-                route_name = (
-                    routes[routes["route_id"].isin(route_id)][
-                        "route_short_name"
-                    ].values[0]
-                    + "-"
-                    + routes[routes["route_id"].isin(route_id)][
-                        "route_long_name"
-                    ].values[0]
-                )
+            k = self._last_rounds(board_stops, k - 1)
+            components["wait_time"][positions] += (
+                board_times - self._arrivals[k, board_stops]
+            )
+            current = board_stops
 
-                boarding_stop_time = stop_times[
-                    (stop_times["trip_id"] == current_trip_id)
-                    & (stop_times["stop_id"] == prior_stop_id)
-                ]
+        components = {
+            name: np.where(is_reached, values, np.nan)
+            for name, values in components.items()
+        }
+        components["travel_time"] = np.full(len(stops), np.nan)
+        components["travel_time"][is_reached] = (
+            self._best[stops[is_reached]] - self._departure_time
+        )
 
-                boarding_time = boarding_stop_time["departure_time"].values[0]
+        return components
 
+    def _get_trip_segment(
+        self,
+        prior_stop_mp,
+        current_stop_mp,
+        current_trip_id,
+        epsg=ALBERS_EQUAL_AREA_CONICAL_EPSG,
+    ):
+        from shapely.geometry import LineString
 
-                alight_stop_time = stop_times[
-                    (stop_times["trip_id"] == current_trip_id)
-                    & (stop_times["stop_id"] == current_stop_id)
-                ]
+        index = feed_index(self._gtfs_feed)
+        shape_id = index.trip(current_trip_id)["shape_id"]
+        coords = index.shape_line(shape_id, epsg).segment_coords(
+            prior_stop_mp, current_stop_mp
+        )
 
-                alight_time = alight_stop_time["arrival_time"].values[0]
+        return LineString(np.column_stack(index.to_lat_lon(epsg)(*coords.T)))
 
+    def describe_path(
+        self,
+        to_stop_id: str,
+        epsg: Optional[int] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
+        geometry: Optional[bool] = True,
+    ) -> Union[pd.DataFrame, "gpd.GeoDataFrame"]:
+        if not self.has_stop(to_stop_id):
+            raise KeyError(to_stop_id)
+
+        legs = self.describe_paths([to_stop_id], epsg=epsg, geometry=geometry)
+        legs = legs.droplevel("destination")
+        legs.index.name = None
+        return legs
+
+    def describe_paths(
+        self,
+        to_stop_ids: List[str],
+        epsg: Optional[int] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
+        geometry: Optional[bool] = True,
+    ) -> Union[pd.DataFrame, "gpd.GeoDataFrame"]:
+        """Describe the journeys to many stops at once.
+
+        Legs shared between journeys, such as the trips out of the origin, are
+        described once, and the stop, trip, route and stop time attributes of all
+        legs are joined in a single pass.
+
+        Without geometry, no shapes are cut or reprojected and neither shapely nor
+        pyproj is imported, so the feed does not need to be loaded as a geo feed.
+
+        :param to_stop_ids: The destination stops. Stops not reached are left out.
+        :param epsg: Projection the shapes are cut in
+        :param geometry: Return a GeoDataFrame with the line of each leg, or a plain
+            DataFrame of the legs without it
+        :return: The legs of every journey, indexed by (destination, leg), with the
+            columns of describe_path
+        """
+        if self._gtfs_feed is None:
+            raise ValueError(
+                "A feed is required to describe paths, for their stops, routes, "
+                "geometry and shape distances. Pass the feed to raptor_assignment "
+                "along with the timetable."
+            )
+        index = feed_index(self._gtfs_feed)
+        stop_ids = self._timetable.stop_ids
+        trip_ids = self._timetable.trip_ids
+
+        destinations = []
+        leg_numbers = []
+        path_legs = []
+        for to_stop_id in to_stop_ids:
+            if not self.has_stop(to_stop_id):
+                logger.warning("Destination {} was not reached".format(to_stop_id))
+                continue
 
+            path = self._path(self._timetable.stop_index([to_stop_id])[0])
+            destinations.extend([to_stop_id] * len(path))
+            leg_numbers.extend(range(len(path)))
+            path_legs.extend(path)
 
-                segments[x] = self._get_trip_segment(
-                    boarding_stop_time["shape_dist_traveled"].values[0],
-                    alight_stop_time["shape_dist_traveled"].values[0],
-                    current_trip_id,
-                    epsg=epsg,
-                )
-                mode[x] = "transit"
-
-                out_messages[x] = (
-                    "Board Route {route_name} at {prior_stop_name}({prior_stop_id}) at {boarding_time} -> "
-                    "Arrive at {current_stop_name}({current_stop_id}) at {alight_time}".format(
-                        route_name=route_name,
-                        prior_stop_name=prior_stop_name,
-                        prior_stop_id=prior_stop_id,
-                        boarding_time=StopAccessState._format_time(boarding_time),
-                        current_stop_name=current_stop_name,
-                        current_stop_id=current_stop_id,
-                        alight_time=StopAccessState._format_time(alight_time),
-                    )
+        # describe each distinct leg once
+        legs, leg_of_journey = np.unique(
+            np.array(path_legs, dtype=np.int64).reshape(-1, 6),
+            axis=0,
+            return_inverse=True,
+        )
+        leg_of_journey = leg_of_journey.ravel()
+        leg_types, from_stops, to_stops, trips, board_positions, alight_positions = (
+            legs.T
+        )
+        is_transit = leg_types == TRANSIT
+
+        from_stop_ids = stop_ids[from_stops]
+        to_stop_ids = stop_ids[to_stops]
+        from_rows = index.stop_rows(from_stop_ids)
+        to_rows = index.stop_rows(to_stop_ids)
+        stop_names = index.stops["stop_name"].to_numpy()
+        stop_lon, stop_lat = index.stop_coordinates()
+
+        descriptions = np.array(
+            [
+                "Walk from {}({}) to {}({})".format(
+                    from_name, from_stop_id, to_name, to_stop_id
                 )
-            else:  # Walk connection
-                mode[x] = "walk"
-                color[x] = "#000000"
-                current_stop_geom = stops[stops["stop_id"] == current_stop_id][
-                    "geometry"
-                ].values[0]
-                prior_stop_geom = stops[stops["stop_id"] == prior_stop_id][
-                    "geometry"
-                ].values[0]
-
-                segments[x] = LineString([prior_stop_geom, current_stop_geom])
-                out_messages[x] = "Walk from {}({}) to {}({})".format(
-                    prior_stop_name,
-                    prior_stop_id,
-                    current_stop_name,
-                    current_stop_id,
-                    current_trip_id,
+                for from_name, from_stop_id, to_name, to_stop_id in zip(
+                    stop_names[from_rows],
+                    from_stop_ids,
+                    stop_names[to_rows],
+                    to_stop_ids,
                 )
+            ],
+            dtype=object,
+        )
+        colors = np.full(len(legs), "#000000", dtype=object)
 
-            current_stop = prior_stop
-            current_stop_id = prior_stop_id
-
-        # counter = 1
-        # sorted_messages = {}
-        # sorted_segments = {}
-        # for i in sorted(list(out_messages.keys())):
-        #    sorted_messages[counter] = out_messages[i]
-        #    if i in segments.keys():
-        #        sorted_segments[counter] = segments[i]
-        #    counter = counter + 1
-        return gpd.GeoDataFrame(
-            index=segments.keys(),
+        # route and stop time attributes of the transit legs, the stop times found by
+        # their position in the trip, as a loop route visits some stops twice
+        trip = trip_ids[trips[is_transit]]
+        route_rows = index.route_rows(
+            index.trips["route_id"].to_numpy()[index.trip_rows(trip)]
+        )
+        routes = index.routes.iloc[route_rows]
+        boarding = index.stop_times.iloc[
+            index.stop_time_rows(trip, board_positions[is_transit])
+        ]
+        alighting = index.stop_times.iloc[
+            index.stop_time_rows(trip, alight_positions[is_transit])
+        ]
+
+        colors[is_transit] = "#" + routes["route_color"].to_numpy(dtype=object)
+        route_names = (
+            routes["route_short_name"] + "-" + routes["route_long_name"]
+        ).to_numpy()
+        descriptions[is_transit] = [
+            "Board Route {route_name} at {prior_stop_name}({prior_stop_id}) at {boarding_time} -> "
+            "Arrive at {current_stop_name}({current_stop_id}) at {alight_time}".format(
+                route_name=route_name,
+                prior_stop_name=prior_stop_name,
+                prior_stop_id=prior_stop_id,
+                boarding_time=StopAccessState._format_time(boarding_time),
+                current_stop_name=current_stop_name,
+                current_stop_id=current_stop_id,
+                alight_time=StopAccessState._format_time(alight_time),
+            )
+            for (
+                route_name,
+                prior_stop_name,
+                prior_stop_id,
+                boarding_time,
+                current_stop_name,
+                current_stop_id,
+                alight_time,
+            ) in zip(
+                route_names,
+                stop_names[from_rows[is_transit]],
+                from_stop_ids[is_transit],
+                boarding["departure_time"],
+                stop_names[to_rows[is_transit]],
+                to_stop_ids[is_transit],
+                alighting["arrival_time"],
+            )
+        ]
+        transit_modes = np.where(is_transit, "transit", "walk")
+        legs = pd.DataFrame(
+            index=pd.MultiIndex.from_arrays(
+                [destinations, leg_numbers], names=["destination", "leg"]
+            ),
             data={
-                "from_stop_id": from_stop.values(),
-                "to_stop_id": to_stop.values(),
-                "from_stop_name": from_name.values(),
-                "to_stop_name": to_name.values(),
-                "from_stop_lat": from_stop_lat.values(),
-                "from_stop_lon": from_stop_lon.values(),
-                "to_stop_lat": to_stop_lat.values(),
-                "to_stop_lon": to_stop_lon.values(),
-                "description": out_messages.values(),
-                "transit_mode": mode.values(),
-                "color": color.values(),
+                "from_stop_id": from_stop_ids[leg_of_journey],
+                "to_stop_id": to_stop_ids[leg_of_journey],
+                "from_stop_name": stop_names[from_rows][leg_of_journey],
+                "to_stop_name": stop_names[to_rows][leg_of_journey],
+                "from_stop_lat": stop_lat[from_rows][leg_of_journey],
+                "from_stop_lon": stop_lon[from_rows][leg_of_journey],
+                "to_stop_lat": stop_lat[to_rows][leg_of_journey],
+                "to_stop_lon": stop_lon[to_rows][leg_of_journey],
+                "description": descriptions[leg_of_journey],
+                "transit_mode": transit_modes[leg_of_journey],
+                "color": colors[leg_of_journey],
             },
-            geometry=list(segments.values()),
-            crs="epsg:4326",
         )
+        if not geometry:
+            return legs
+
+        import geopandas as gpd
+        from shapely.geometry import LineString
+
+        # walks are straight lines, transit legs follow the shape of their trip
+        segments = [
+            LineString([(from_lon, from_lat), (to_lon, to_lat)])
+            for from_lon, from_lat, to_lon, to_lat in zip(
+                stop_lon[from_rows],
+                stop_lat[from_rows],
+                stop_lon[to_rows],
+                stop_lat[to_rows],
+            )
+        ]
+        for position, prior_stop_mp, current_stop_mp, current_trip_id in zip(
+            np.flatnonzero(is_transit),
+            boarding["shape_dist_traveled"],
+            alighting["shape_dist_traveled"],
+            trip,
+        ):
+            segments[position] = self._get_trip_segment(
+                prior_stop_mp, current_stop_mp, current_trip_id, epsg=epsg
+            )
 
-        # return sorted_messages, segments
+        return gpd.GeoDataFrame(
+            legs,
+            geometry=[segments[leg] for leg in leg_of_journey],
+            crs="epsg:4326",
+        )
 
     @staticmethod
     def _format_time(seconds: float) -> str:
@@ -287,246 +586,297 @@ class StopAccessState:
         return "{:02.0f}:{:02.0f}:{:02.0f}".format(hours, minutes, seconds)
 
 
-def _get_trip_ids_for_stop_new(
-    stop_times: pd.DataFrame, stop_ids: List[str], departure_time: int
-):
-    """Takes a stop and departure time and get associated trip ids."""
-    mask_1 = stop_times.stop_id.isin(stop_ids)
-    # mask_2 = stop_times.departure_time >= departure_time
-    # mask_3 = stop_times.departure_time <= departure_time + 120 * 60
-
-    # extract the list of qualifying trip ids
-    potential_trips = stop_times[mask_1][
-        ["trip_id", "stop_id", "departure_time", "arrival_time", "stop_sequence"]
-    ].drop_duplicates()
-    return potential_trips
+def _row_searchsorted(block: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Vectorized np.searchsorted(block[i], values[i]) for every row of a sorted block."""
+    rows = np.arange(block.shape[0])
+    lo = np.zeros(block.shape[0], dtype=np.int64)
+    hi = np.full(block.shape[0], block.shape[1], dtype=np.int64)
+
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+
+        mid = (lo + hi) // 2
+        go_right = block[rows, np.minimum(mid, block.shape[1] - 1)] < values
+        lo = np.where(active & go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+
+
+def _scan_route(
+    timetable: Timetable,
+    route: int,
+    start: int,
+    time_available: np.ndarray,
+    best_arrivals: np.ndarray,
+    time_bound: float = np.inf,
+) -> Tuple[np.ndarray, ...]:
+    """Traverse a single route from the first marked stop position.
+
+    Returns the stops reached along with their arrival time, the trip taken, the
+    stop the trip was boarded at, its departure from there and the route positions
+    the trip was boarded and alighted at. Only arrivals that beat both the best
+    arrival at the stop and the time bound are returned.
+    """
+    stops = timetable.route_stop_ids(route)[start:]
+    arrivals, departures = timetable.route_times(route)
+
+    # only the trips still running once a stop can be left, and leaving the first
+    # stop before the time bound, are searched
+    first = np.searchsorted(departures[-1], time_available[stops].min())
+    last = np.searchsorted(departures[start], time_bound)
+    arrivals = arrivals[start:, first:last]
+    departures = departures[start:, first:last]
+    num_trips = departures.shape[1]
+
+    # earliest trip that can be caught at each stop position, and the earliest
+    # trip caught at any stop position up to this one
+    catchable = _row_searchsorted(departures, time_available[stops])
+    riding = np.minimum.accumulate(catchable)
+
+    # the stop position at which the trip being ridden was boarded
+    positions = np.arange(len(stops))
+    changed = np.r_[True, riding[1:] < riding[:-1]]
+    boarded_at = np.maximum.accumulate(np.where(changed, positions, 0))
+
+    # a trip can only be alighted after the stop it was boarded at
+    riding = riding[:-1]
+    is_valid = riding < num_trips
+    alight = positions[1:][is_valid]
+    riding = riding[is_valid]
+    boarded_at = boarded_at[:-1][is_valid]
+
+    # local and target pruning
+    arrive_times = arrivals[alight, riding]
+    improves = arrive_times < np.minimum(best_arrivals[stops[alight]], time_bound)
+
+    riding = riding[improves]
+    boarded_at = boarded_at[improves]
+    return (
+        stops[alight[improves]],
+        arrive_times[improves],
+        timetable.route_trip_ids(route)[first + riding],
+        stops[boarded_at],
+        departures[boarded_at, riding],
+        start + boarded_at,
+        start + alight[improves],
+    )
 
 
-def _remove_prior_trips(potential_trips: pd.DataFrame, prior_trips: List[tuple]):
-    tuples_in_df = pd.MultiIndex.from_frame(potential_trips[["stop_id", "trip_id"]])
-    return potential_trips[~tuples_in_df.isin(prior_trips)].copy()
+def _target_bound(stops_state: StopAccessState, target: int) -> float:
+    """Best known arrival at the destination, which no useful label can exceed."""
+    if target < 0:
+        return stops_state.latest_arrival
+    return min(stops_state.best_arrivals[target], stops_state.latest_arrival)
 
 
-def _stop_times_for_kth_trip(
+def _scan_routes_for_kth_trip(
     stops_state: StopAccessState,
-    last_updated_stops: List[str],
-    stop_times: pd.DataFrame,
-    departure_time: float,
+    last_updated_stops: np.ndarray,
+    timetable: Timetable,
     k: int,
-) -> None:
-    tic = time.perf_counter()
-    # find all trips already related to these stop
-    prior_trips = stops_state.get_preceding_trips(last_updated_stops)
-
-    # find all qualifying potential trips with these stops
-    potential_trips = _get_trip_ids_for_stop_new(
-        stop_times, last_updated_stops, departure_time
-    )
-
-    if prior_trips:
-        potential_trips = _remove_prior_trips(potential_trips, prior_trips)
+    target: int = -1,
+    stats: Optional[QueryStats] = None,
+) -> np.ndarray:
+    # time each stop can be left from, given the trips taken in earlier rounds
+    time_available = stops_state.best_arrivals
+    routes, starts = timetable.routes_serving(last_updated_stops)
 
-    # trip_stop_pairings = potential_trips.groupby('trip_id')['stop_id'].apply(list).to_dict()
-    toc = time.perf_counter()
-    logger.debug("\t\tTrip Pairings calculated in {:0.4f} seconds".format(toc - tic))
+    if stats is not None:
+        stats.add(k, "routes_scanned", len(routes))
 
     # This is a dead end...
-    if potential_trips.empty:
-        return False
-
-    tic = time.perf_counter()
-
-    last_stop_evaluated = potential_trips.loc[
-        potential_trips.groupby("trip_id")["arrival_time"].idxmax()
+    if len(routes) == 0:
+        return np.empty(0, dtype=np.int32)
+
+    time_bound = _target_bound(stops_state, target)
+    results = [
+        _scan_route(
+            timetable,
+            route,
+            start,
+            time_available,
+            stops_state.best_transit_arrivals,
+            time_bound,
+        )
+        for route, start in zip(routes, starts)
     ]
-    last_stop_states = stops_state.get_stops(
-        list(last_stop_evaluated["stop_id"].unique())
-    )
-    last_stop_states = pd.DataFrame(
-        index=last_stop_states.keys(), data=last_stop_states.values()
-    )
-    last_stop_evaluated = pd.merge(
-        last_stop_evaluated,
-        last_stop_states,
-        left_on="stop_id",
-        right_index=True,
-        how="left",
+    (
+        arrive_stops,
+        arrive_times,
+        trips,
+        board_stops,
+        board_times,
+        board_positions,
+        alight_positions,
+    ) = (np.concatenate(x) for x in zip(*results))
+
+    updated_stops = stops_state.try_add_transit(
+        k,
+        arrive_stops,
+        arrive_times,
+        trips,
+        board_stops,
+        board_times,
+        board_positions,
+        alight_positions,
     )
 
-    last_stop_evaluated = pd.merge(
-        stop_times, last_stop_evaluated, on="trip_id", suffixes=["", "_preceding"]
-    )
-    # Only want to consider what happens after the stop in question
-    filter1 = (
-        last_stop_evaluated["stop_sequence"]
-        >= last_stop_evaluated["stop_sequence_preceding"]
-    )
-    # A traveler can only use trips that leave after they arrive at the station
-    filter2 = (
-        last_stop_evaluated["departure_time_preceding"]
-        >= last_stop_evaluated["time_to_reach"] + departure_time
-    )
-
-    last_stop_evaluated = last_stop_evaluated[filter1 & filter2].copy()
-
-    last_stop_evaluated["arrive_time_adjusted"] = (
-        last_stop_evaluated["arrival_time"] - departure_time
-    )  # + last_stop_evaluated['time_to_reach']
-
-    # routes_evaluated = trips[trips['trip_id'].isin(last_stop_evaluated['trip_id'].unique())]
-    # logger.debug('Routes Evaluated: {}'.format(routes_evaluated['route_id'].unique()))
-
-    for (
-        arrive_stop_id,
-        arrive_time_adjusted,
-        trip_id,
-        preceding_stop,
-        preceding_path,
-    ) in last_stop_evaluated[
-        ["stop_id", "arrive_time_adjusted", "trip_id", "stop_id_preceding", "preceding"]
-    ].itertuples(
-        index=False, name=None
-    ):
-
-        stops_state.try_add_update(
-            arrive_stop_id,
-            arrive_time_adjusted,
-            trip_id,
-            preceding_stop,
-            preceding_path,
-            k * 2,
-        )
-
-    toc = time.perf_counter()
-    logger.debug(
-        "\t\t'Iterate' New Trip Pairings calculated in {:0.4f} seconds".format(
-            toc - tic
-        )
-    )
+    if stats is not None:
+        stats.add(k, "trips_boarded", len(np.unique(trips)))
+        stats.add(k, "transit_labels_improved", len(updated_stops))
 
-    return True
+    return updated_stops
 
 
 def _add_footpath_transfers(
     stops_state: StopAccessState,
-    transfers: pd.DataFrame,
-    already_processed_stops: List[str],
-    k,
-) -> List[str]:
-    # initialize a return object
-    updated_stop_ids = []
-
+    footpaths: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    stops_to_process: np.ndarray,
+    k: int,
+    target: int = -1,
+    stats: Optional[QueryStats] = None,
+) -> np.ndarray:
     # add in transfers to nearby stops
-    stop_ids = stops_state.all_stops()
+    from_stops, to_stops, walk_times = footpaths_from(footpaths, stops_to_process)
 
-    stop_xfers = transfers[
-        (transfers["from_stop_id"].isin(stop_ids))
-        & (~transfers["from_stop_id"].isin(already_processed_stops))
-    ].copy()
+    if stats is not None:
+        stats.add(k, "footpaths_relaxed", len(from_stops))
 
     # No transfer from the stops
-    if stop_xfers.empty:
-        return updated_stop_ids
-
-    ref_stop_state = [
-        {
-            "from_stop_id": stop_id,
-            "time_to_reach": vals["time_to_reach"],
-            "preceding": vals["preceding"],
-        }
-        for stop_id, vals in stops_state._stops.items()
-    ]
-
-    ref_stop_state = pd.DataFrame(ref_stop_state)
+    if len(from_stops) == 0:
+        return np.empty(0, dtype=np.int32)
+
+    # footpaths start from the arrival by trip, or the origin in the first round
+    leave_times = (
+        stops_state.arrivals_in_round(0)
+        if k == 0
+        else stops_state.best_transit_arrivals
+    )
+    arrive_times = leave_times[from_stops] + walk_times
 
-    stop_xfers = pd.merge(stop_xfers, ref_stop_state, on="from_stop_id", how="left")
+    # target pruning
+    improves = arrive_times < _target_bound(stops_state, target)
 
-    stop_xfers["arrive_time_adjusted"] = (
-        stop_xfers["time_to_reach"] + stop_xfers["min_transfer_time"]
-    )
-    stop_xfers = stop_xfers.loc[
-        stop_xfers.groupby("to_stop_id")["arrive_time_adjusted"].idxmin()
-    ]
-    stop_xfers["last_trip_id"] = stop_xfers.apply(
-        lambda x: x["preceding"][-1] if len(x["preceding"]) else "", axis=1
+    updated_stops = stops_state.try_add_walk(
+        k, to_stops[improves], arrive_times[improves], from_stops[improves]
     )
 
-    for i, row in stop_xfers.iterrows():
-        did_update = stops_state.try_add_update(
-            row["to_stop_id"],
-            row["arrive_time_adjusted"],
-            row["last_trip_id"],
-            preceding_stop=row["from_stop_id"],
-            k=k * 2 + 1,
-        )
-
-        if did_update:
-            updated_stop_ids.append(row["to_stop_id"])
+    if stats is not None:
+        stats.add(k, "walk_labels_improved", len(updated_stops))
 
-    return updated_stop_ids
+    return updated_stops
 
 
 def raptor_assignment(
-    feed, from_stop_id, to_stop_id, departure_time, transfers, transfer_limit
+    feed,
+    from_stop_id,
+    to_stop_id,
+    departure_time,
+    transfers,
+    transfer_limit,
+    timetable: Optional[Timetable] = None,
+    max_duration: Optional[float] = None,
+    stats: Optional[QueryStats] = None,
 ) -> StopAccessState:
-    stop_state = StopAccessState(from_stop_id, feed)
-    stop_times = feed.stop_times
-
-    already_processed_xfers = []
-    just_updated_stops = [from_stop_id]
-
-    for k in range(transfer_limit + 1):
-        logger.debug("\nAnalyzing possibilities with {} transfers".format(k))
+    """Find the earliest arrival at a destination stop.
+
+    Labels that cannot beat the best known arrival at the destination are pruned,
+    and rounds stop once no marked stop can improve on it. Pass None as the
+    to_stop_id for a one-to-all query that finds the earliest arrival at every stop.
+
+    Route scans only search the trips that are still running when a marked stop can
+    be left and that start before the destination can be improved on, so a query
+    horizon (max_duration) keeps the trips later in the day out of every round.
+
+    :param to_stop_id: The destination stop, None for a one-to-all query. A stop
+        missing from the timetable raises a KeyError, like the origin.
+    :param transfers: Footpaths between stops. None uses the footpaths the
+        timetable was compiled with.
+    :param timetable: A Timetable compiled from the feed. Compiling takes much
+        longer than a single query, so compile once and reuse it across queries.
+    :param max_duration: Query horizon, in seconds. Only stops reached before
+        departure_time + max_duration are labelled.
+    :param stats: Collects the marked stops, routes scanned, trips boarded, labels
+        improved, footpaths relaxed and time spent in each round of the query
+    """
+    if timetable is None:
+        timetable = compile_timetable(feed, transfers)
+
+    stop_state = StopAccessState(
+        from_stop_id, feed, timetable, departure_time, transfer_limit, max_duration
+    )
+    footpaths = timetable.footpaths(transfers)
+
+    target = -1
+    if to_stop_id is not None:
+        target = timetable.stop_index([to_stop_id])[0]
+        if target < 0:
+            raise KeyError("No stop_id found for: {}".format(to_stop_id))
+
+    # the origin can be walked away from before boarding the first trip
+    origin = timetable.stop_index([from_stop_id])
+    if stats is not None:
+        stats.add(0, "marked_stops", len(origin))
+        tic = time.perf_counter()
+    just_updated_stops = np.union1d(
+        origin,
+        _add_footpath_transfers(stop_state, footpaths, origin, 0, target, stats),
+    )
+    if stats is not None:
+        stats.add(0, "footpath_time", time.perf_counter() - tic)
+        stats.end_round(0)
+
+    # round k finds the stops improved by taking k trips
+    for k in range(1, transfer_limit + 2):
+        # a marked stop reached after the destination cannot lead to a better arrival
+        just_updated_stops = just_updated_stops[
+            stop_state.best_arrivals[just_updated_stops]
+            < _target_bound(stop_state, target)
+        ]
+        if len(just_updated_stops) == 0:
+            break
 
-        stop_ids = stop_state.all_stops()
-        logger.debug("\tinital qualifying stop ids count: {}".format(len(stop_ids)))
+        if stats is not None:
+            stats.add(k, "marked_stops", len(just_updated_stops))
+            tic = time.perf_counter()
 
-        # update time to stops calculated based on stops accessible
-        tic = time.perf_counter()
-        _stop_times_for_kth_trip(
-            stop_state, just_updated_stops, stop_times, departure_time, k
+        # update time to stops calculated based on routes serving the marked stops
+        transit_updated_stops = _scan_routes_for_kth_trip(
+            stop_state, just_updated_stops, timetable, k, target, stats
         )
-        toc = time.perf_counter()
-        logger.debug("\tstop times calculated in {:0.4f} seconds".format(toc - tic))
 
-        added_keys_count = len(stop_state.all_stops()) - len(stop_ids)
-        logger.debug("\t\t{} stop ids added".format(added_keys_count))
+        if stats is not None:
+            toc = time.perf_counter()
+            stats.add(k, "scan_time", toc - tic)
 
-        if added_keys_count == 0:
+        if len(transit_updated_stops) == 0:
+            if stats is not None:
+                stats.end_round(k)
+            # formatted only when the message is logged, as this ends many queries
             logger.info(
-                "No valid transfers found after iteration {} for stop pair {}->{}".format(
-                    k, from_stop_id, to_stop_id
-                )
+                "No valid transfers found after iteration %s for stop pair %s->%s",
+                k - 1,
+                from_stop_id,
+                to_stop_id,
             )
             break
 
-        # reset stop_ids count
-        stop_ids = stop_state.all_stops()
-
         # now add footpath transfers and update
-        tic = time.perf_counter()
-        just_updated_stops_temp = just_updated_stops
-        just_updated_stops = _add_footpath_transfers(
-            stop_state, transfers, already_processed_xfers, k
-        )
-        toc = time.perf_counter()
-        logger.debug(
-            "\tfootpath transfers calculated in {:0.4f} seconds".format(toc - tic)
+        walk_updated_stops = _add_footpath_transfers(
+            stop_state, footpaths, transit_updated_stops, k, target, stats
         )
 
-        added_keys_count = len(stop_state.all_stops()) - len(stop_ids)
-        logger.debug("\t\t{} stop ids added".format(added_keys_count))
+        if stats is not None:
+            stats.add(k, "footpath_time", time.perf_counter() - toc)
+            stats.end_round(k)
 
-        logger.debug(
-            "\talready processed count increased from {} to {}".format(
-                len(already_processed_xfers),
-                len(already_processed_xfers + just_updated_stops_temp),
-            )
-        )
-        logger.debug("\tnew stops to process: {}".format(len(just_updated_stops)))
-        already_processed_xfers += just_updated_stops_temp
+        just_updated_stops = np.union1d(transit_updated_stops, walk_updated_stops)
+
+    if stats is not None:
+        stats.end_query()
 
-    if not stop_state.has_stop(to_stop_id):
+    if to_stop_id is not None and not stop_state.has_stop(to_stop_id):
         logger.warning(
             "Unable to find route to destination ({}->{}) within transfer limit".format(
                 from_stop_id, to_stop_id
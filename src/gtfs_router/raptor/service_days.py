@@ -0,0 +1,143 @@
+import datetime
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Optional
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router.raptor.timetable import Timetable, compile_timetable
+from gtfs_router.utils.ids import intern_feed_ids
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+# Default number of compiled service days kept, two weeks of daily queries
+DEFAULT_MAX_DAYS = 14
+
+
+def service_ids_by_date(feed) -> Dict[datetime.date, FrozenSet[str]]:
+    """Active service_ids on each date, from calendar.txt and calendar_dates.txt.
+
+    :param feed: A Partridge GTFS datafeed, loaded without a date view
+    :return: The service_ids running on every date with service
+    """
+    calendar = getattr(feed, "calendar", None)
+    if calendar is None or calendar.empty:
+        calendar = pd.DataFrame(
+            columns=["service_id", "start_date", "end_date"] + WEEKDAYS
+        )
+    calendar_dates = getattr(feed, "calendar_dates", None)
+    if calendar_dates is None or calendar_dates.empty:
+        calendar_dates = pd.DataFrame(columns=["service_id", "date", "exception_type"])
+
+    # every date between the start and end of each service, on its weekdays
+    start_dates = pd.to_datetime(calendar["start_date"]).to_numpy("datetime64[D]")
+    end_dates = pd.to_datetime(calendar["end_date"]).to_numpy("datetime64[D]")
+    num_days = np.maximum((end_dates - start_dates).astype(np.int64) + 1, 0)
+
+    rows = np.repeat(np.arange(len(calendar)), num_days)
+    day_offsets = np.arange(num_days.sum()) - np.repeat(
+        np.cumsum(num_days) - num_days, num_days
+    )
+    dates = pd.DataFrame(
+        {
+            "service_id": calendar["service_id"].to_numpy()[rows],
+            "date": start_dates[rows] + day_offsets,
+        }
+    )
+    runs_on = calendar[WEEKDAYS].to_numpy(dtype=bool)
+    weekdays = pd.DatetimeIndex(dates["date"]).weekday.to_numpy()
+    dates = dates[runs_on[rows, weekdays]]
+
+    # exceptions add (1) or remove (2) a service on a date
+    exceptions = calendar_dates.assign(
+        date=pd.to_datetime(calendar_dates["date"]).to_numpy("datetime64[D]"),
+        exception_type=pd.to_numeric(calendar_dates["exception_type"]),
+    )
+    removed = exceptions.loc[exceptions["exception_type"] == 2, ["service_id", "date"]]
+    dates = dates.merge(removed, how="left", indicator=True)
+    dates = dates.loc[dates.pop("_merge") == "left_only", ["service_id", "date"]]
+    dates = pd.concat(
+        [
+            dates,
+            exceptions.loc[exceptions["exception_type"] == 1, ["service_id", "date"]],
+        ]
+    )
+
+    return {
+        date.date(): frozenset(service_ids)
+        for date, service_ids in dates.groupby("date")["service_id"]
+    }
+
+
+class ServiceDayTimetables:
+    def __init__(
+        self,
+        feed,
+        transfers: Optional[pd.DataFrame] = None,
+        max_days: Optional[int] = DEFAULT_MAX_DAYS,
+    ):
+        """Timetables compiled for a single service day, cached by date.
+
+        The calendar of the feed is read once, and the timetable of a date is compiled
+        from the trips of its active services the first time it is asked for. Dates
+        running the same services share a timetable, and the least recently used
+        timetable is dropped once more than max_days are held. Ids are interned once
+        for the whole feed, so stop and trip codes are the same in every timetable.
+
+        :param feed: A Partridge GTFS datafeed, loaded without a date view
+        :param transfers: Footpaths between stops, defaults to the transfers of the feed
+        :param max_days: Number of compiled timetables to keep
+        """
+        self._feed = feed
+        self._transfers = feed.transfers if transfers is None else transfers
+        self._max_days = max_days
+
+        self.ids = intern_feed_ids(feed)
+        self.service_ids_by_date = service_ids_by_date(feed)
+
+        self._timetables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def service_ids(self, date: datetime.date) -> FrozenSet[str]:
+        return self.service_ids_by_date.get(date, frozenset())
+
+    def __getitem__(self, date: datetime.date) -> Timetable:
+        service_ids = self.service_ids(date)
+
+        # dates running the same services share a timetable
+        if service_ids in self._timetables:
+            self.hits += 1
+            self._timetables.move_to_end(service_ids)
+            return self._timetables[service_ids]
+
+        self.misses += 1
+        tic = time.perf_counter()
+        timetable = compile_timetable(
+            self._feed, self._transfers, ids=self.ids, service_ids=service_ids
+        )
+        toc = time.perf_counter()
+        logger.debug(
+            "Timetable of {} compiled in {:0.4f} seconds".format(date, toc - tic)
+        )
+
+        self._timetables[service_ids] = timetable
+        if len(self._timetables) > self._max_days:
+            self._timetables.popitem(last=False)
+
+        return timetable
+
+    def __len__(self) -> int:
+        return len(self._timetables)
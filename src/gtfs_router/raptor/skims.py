@@ -0,0 +1,181 @@
+import logging
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router.raptor.raptor import raptor_assignment
+from gtfs_router.raptor.timetable import Timetable, compile_timetable
+
+logger = logging.getLogger(__name__)
+
+SKIM_MEASURES = [
+    "travel_time",
+    "in_vehicle_time",
+    "wait_time",
+    "walk_time",
+    "boardings",
+]
+
+NPY = "npy"
+PARQUET = "parquet"
+
+# Default number of origins whose skims are held in memory before being written
+DEFAULT_ORIGIN_CHUNK_SIZE = 256
+
+
+def _write_chunk(
+    output_dir: str,
+    chunk: int,
+    origins: np.ndarray,
+    skims: dict,
+    file_format: str,
+    sparse: bool,
+):
+    if file_format == NPY and not sparse:
+        for measure, values in skims.items():
+            np.save(
+                os.path.join(output_dir, "{}_{:05d}.npy".format(measure, chunk)), values
+            )
+        return
+
+    rows, cols = np.nonzero(
+        ~np.isnan(skims["travel_time"])
+        if sparse
+        else np.ones(skims["travel_time"].shape, dtype=bool)
+    )
+
+    if file_format == NPY:
+        np.savez(
+            os.path.join(output_dir, "skims_{:05d}.npz".format(chunk)),
+            origin=origins[rows],
+            destination=cols.astype(np.int32),
+            **{measure: values[rows, cols] for measure, values in skims.items()},
+        )
+    else:
+        pd.DataFrame(
+            {
+                "origin": origins[rows],
+                "destination": cols.astype(np.int32),
+                **{measure: values[rows, cols] for measure, values in skims.items()},
+            }
+        ).to_parquet(
+            os.path.join(output_dir, "skims_{:05d}.parquet".format(chunk)), index=False
+        )
+
+
+def build_skims(
+    feed,
+    from_stop_ids: List[str],
+    departure_time: float,
+    transfers: Optional[pd.DataFrame],
+    transfer_limit: int,
+    output_dir: str,
+    to_stop_ids: Optional[List[str]] = None,
+    timetable: Optional[Timetable] = None,
+    chunk_size: Optional[int] = DEFAULT_ORIGIN_CHUNK_SIZE,
+    file_format: Optional[str] = NPY,
+    sparse: Optional[bool] = False,
+    max_duration: Optional[float] = None,
+) -> str:
+    """Write stop-to-stop skims from one-to-all RAPTOR queries.
+
+    Each origin is routed once to every stop, and the travel time components of all
+    destinations are read off the labels of that single query. Skims are written a
+    chunk of origins at a time, so memory is bounded by chunk_size x destinations.
+
+    Files written to the output directory:
+        origins.csv / destinations.csv: the stop_id of each row / column index
+        dense npy: {measure}_{chunk}.npy, (origins in chunk x destinations) float
+            matrices with NaN for stops not reached
+        sparse npy: skims_{chunk}.npz, with origin and destination index arrays
+            and one value array per measure for the stops reached
+        parquet: skims_{chunk}.parquet, a long table of origin, destination and
+            measures. Sparse tables leave out the stops not reached.
+
+    :param feed: A Partridge GTFS datafeed, only used if no timetable is given
+    :param from_stop_ids: The origin stops
+    :param departure_time: Departure time from the origins, in seconds
+    :param transfers: Footpaths between stops, None for those of the timetable
+    :param transfer_limit: Maximum number of transfers between trips
+    :param output_dir: Directory the skims are written to, created if needed
+    :param to_stop_ids: The destination stops, defaults to every stop
+    :param timetable: A Timetable compiled from the feed
+    :param chunk_size: Number of origins written per file
+    :param file_format: 'npy' or 'parquet', which requires pyarrow or fastparquet,
+        e.g. from the parquet extra: pip install gtfs_router[parquet]
+    :param sparse: Only write the origin-destination pairs that are reached
+    :param max_duration: Query horizon, in seconds. Only stops reached before
+        departure_time + max_duration are labelled.
+    :return: The output directory
+    """
+    if file_format not in [NPY, PARQUET]:
+        raise ValueError("file_format must be one of {}".format([NPY, PARQUET]))
+    if file_format == PARQUET:
+        # raises an ImportError naming the engines before any origin is routed
+        pd.io.parquet.get_engine("auto")
+
+    tic = time.perf_counter()
+
+    if timetable is None:
+        timetable = compile_timetable(feed, transfers)
+    if to_stop_ids is None:
+        to_stop_ids = timetable.stop_ids
+
+    from_stop_ids = np.asarray(from_stop_ids, dtype=object)
+    to_stop_ids = np.asarray(to_stop_ids, dtype=object)
+
+    os.makedirs(output_dir, exist_ok=True)
+    pd.DataFrame({"stop_id": from_stop_ids}).to_csv(
+        os.path.join(output_dir, "origins.csv"), index_label="index"
+    )
+    pd.DataFrame({"stop_id": to_stop_ids}).to_csv(
+        os.path.join(output_dir, "destinations.csv"), index_label="index"
+    )
+
+    for chunk, start in enumerate(range(0, len(from_stop_ids), chunk_size)):
+        origins = np.arange(start, min(start + chunk_size, len(from_stop_ids)))
+        skims = {
+            measure: np.full((len(origins), len(to_stop_ids)), np.nan, dtype=np.float32)
+            for measure in SKIM_MEASURES
+        }
+
+        for row, from_stop_id in enumerate(from_stop_ids[origins]):
+            if timetable.stop_index([from_stop_id])[0] < 0:
+                logger.warning("No stop_id found for: {}".format(from_stop_id))
+                continue
+
+            stop_state = raptor_assignment(
+                feed,
+                from_stop_id,
+                None,
+                departure_time,
+                transfers,
+                transfer_limit,
+                timetable=timetable,
+                max_duration=max_duration,
+            )
+            components = stop_state.travel_time_components(to_stop_ids)
+            for measure in SKIM_MEASURES:
+                skims[measure][row] = components[measure]
+
+        _write_chunk(
+            output_dir,
+            chunk,
+            origins.astype(np.int32),
+            skims,
+            file_format,
+            sparse,
+        )
+        logger.debug("Skims of origins {} to {} written".format(start, origins[-1]))
+
+    toc = time.perf_counter()
+    logger.info(
+        "Skims from {} origins to {} destinations built in {:0.4f} seconds".format(
+            len(from_stop_ids), len(to_stop_ids), toc - tic
+        )
+    )
+
+    return output_dir
@@ -0,0 +1,90 @@
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+# Counters recorded for every round of a query. Round 0 is the walk from the origin.
+ROUND_COUNTERS = [
+    "marked_stops",
+    "routes_scanned",
+    "trips_boarded",
+    "transit_labels_improved",
+    "footpaths_relaxed",
+    "walk_labels_improved",
+    "scan_time",
+    "footpath_time",
+]
+
+
+class QueryStats:
+    def __init__(self, callback: Optional[Callable[[int, Dict], None]] = None):
+        """Per-round counters of RAPTOR queries.
+
+        Pass an instance as the stats of raptor_assignment or batch_assignment. The
+        counters of every query it sees are added up by round, so a single instance
+        aggregates a whole batch. Queries run without stats skip all of the counting
+        and timing.
+
+        :param callback: Called with the round and its counters as each round of a
+            query ends, e.g. to forward them to a metrics pipeline. The rounds of
+            queries run by batch_assignment workers are passed to it in this
+            process, as the results of each worker are merged.
+        """
+        self.callback = callback
+        self.queries = 0
+        self.rounds = []
+
+        # the rounds ended so far, in order, when they are replayed in another process
+        self.ended_rounds = None
+
+        self._query_rounds = []
+
+    def add(self, k: int, counter: str, value: float):
+        while len(self._query_rounds) <= k:
+            self._query_rounds.append(dict.fromkeys(ROUND_COUNTERS, 0))
+        self._query_rounds[k][counter] += value
+
+    def end_round(self, k: int):
+        """Pass the counters of a round of the query that is running to the callback."""
+        if k >= len(self._query_rounds):
+            return
+        if self.callback is not None:
+            self.callback(k, self._query_rounds[k])
+        if self.ended_rounds is not None:
+            self.ended_rounds.append((k, dict(self._query_rounds[k])))
+
+    def end_query(self):
+        """Add the counters of the query that just ran to the totals."""
+        self.merge_rounds(self._query_rounds)
+
+        self.queries += 1
+        self._query_rounds = []
+
+    def merge_rounds(self, rounds: List[Dict]):
+        for k, counters in enumerate(rounds):
+            if k == len(self.rounds):
+                self.rounds.append(dict.fromkeys(ROUND_COUNTERS, 0))
+            for counter, value in counters.items():
+                self.rounds[k][counter] += value
+
+    def merge(self, other: "QueryStats"):
+        """Add the totals of other, such as the stats collected by a worker process.
+
+        The rounds other recorded in ended_rounds are passed to the callback.
+        """
+        self.merge_rounds(other.rounds)
+        self.queries += other.queries
+
+        for k, counters in other.ended_rounds or []:
+            if self.callback is not None:
+                self.callback(k, counters)
+            if self.ended_rounds is not None:
+                self.ended_rounds.append((k, counters))
+
+    def to_frame(self) -> pd.DataFrame:
+        """The totals as a DataFrame with a row per round and a column per counter."""
+        return pd.DataFrame(
+            self.rounds, columns=ROUND_COUNTERS, index=pd.RangeIndex(len(self.rounds))
+        ).rename_axis("round")
+
+    def to_dict(self) -> Dict:
+        return {"queries": self.queries, "rounds": [dict(x) for x in self.rounds]}
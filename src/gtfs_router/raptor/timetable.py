@@ -0,0 +1,370 @@
+import logging
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router.utils.ids import FeedIds, intern_feed_ids
+
+logger = logging.getLogger(__name__)
+
+
+class Timetable:
+    def __init__(
+        self,
+        ids: FeedIds,
+        trip_routes: np.ndarray,
+        route_stop_offsets: np.ndarray,
+        route_stops: np.ndarray,
+        route_trip_offsets: np.ndarray,
+        route_trips: np.ndarray,
+        route_time_offsets: np.ndarray,
+        arrivals: np.ndarray,
+        departures: np.ndarray,
+        stop_route_offsets: np.ndarray,
+        stop_routes: np.ndarray,
+        stop_route_positions: np.ndarray,
+        transfers: Optional[pd.DataFrame] = None,
+        footpaths: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+        mapped_from: Optional[str] = None,
+    ):
+        """Compiled RAPTOR timetable.
+
+        Trips sharing an identical stop sequence are grouped into RAPTOR routes. Each
+        route stores its stop times as a (stops x trips) block, stop-major, with trips
+        ordered so that every row (stop position) is sorted by departure time.
+
+        Stops, trips and routes are referred to by their interned integer codes.
+        Footpaths are compiled from the transfers, unless an already compiled CSR
+        adjacency is given.
+
+        A timetable whose arrays are memory-mapped from a directory written by
+        compile_feed keeps that directory in mapped_from. It is then pickled as a
+        reference to the directory, so worker processes map the same read-only pages
+        instead of receiving a copy of the arrays.
+        """
+        self.ids = ids
+        self.trip_routes = trip_routes
+
+        self.route_stop_offsets = route_stop_offsets
+        self.route_stops = route_stops
+        self.route_trip_offsets = route_trip_offsets
+        self.route_trips = route_trips
+        self.route_time_offsets = route_time_offsets
+        self.arrivals = arrivals
+        self.departures = departures
+
+        self.stop_route_offsets = stop_route_offsets
+        self.stop_routes = stop_routes
+        self.stop_route_positions = stop_route_positions
+        self.mapped_from = mapped_from
+
+        if footpaths is None:
+            footpaths = self._compile_footpaths(
+                pd.DataFrame(columns=["from_stop_id", "to_stop_id"])
+                if transfers is None
+                else transfers
+            )
+        self._footpaths = footpaths
+
+        # footpaths of the last other transfers table a query was given
+        self._transfers = None
+        self._transfer_footpaths = None
+
+    def __reduce_ex__(self, protocol):
+        if self.mapped_from is None:
+            return super().__reduce_ex__(protocol)
+
+        from gtfs_router.raptor.compiled_feed import _open_mapped_timetable
+
+        return _open_mapped_timetable, (self.mapped_from,)
+
+    @property
+    def stop_ids(self) -> np.ndarray:
+        return self.ids.stops.ids
+
+    @property
+    def trip_ids(self) -> np.ndarray:
+        return self.ids.trips.ids
+
+    @property
+    def num_stops(self) -> int:
+        return len(self.ids.stops)
+
+    @property
+    def num_routes(self) -> int:
+        return len(self.route_stop_offsets) - 1
+
+    def stop_index(self, stop_ids) -> np.ndarray:
+        return self.ids.stops.codes(stop_ids)
+
+    def footpaths(
+        self, transfers: Optional[pd.DataFrame]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Footpaths as a CSR adjacency of (offsets, to stops, walk times).
+
+        The footpaths leaving stop s go to to_stops[offsets[s] : offsets[s + 1]], with
+        int32 stop indices and float32 walk times. Passing None returns the footpaths
+        the timetable was compiled with. The adjacency of another table is kept apart
+        from those, for the last table seen, so passing the same table to every query
+        only compiles it once and never changes the footpaths of later None queries.
+        """
+        if transfers is None:
+            return self._footpaths
+
+        if transfers is not self._transfers:
+            self._transfer_footpaths = self._compile_footpaths(transfers)
+            self._transfers = transfers
+
+        return self._transfer_footpaths
+
+    def _compile_footpaths(
+        self, transfers: pd.DataFrame
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if "min_transfer_time" in transfers.columns:
+            from_stops = self.stop_index(transfers["from_stop_id"])
+            to_stops = self.stop_index(transfers["to_stop_id"])
+            walk_times = transfers["min_transfer_time"].to_numpy(dtype=np.float64)
+        else:
+            from_stops = to_stops = np.empty(0, dtype=np.int32)
+            walk_times = np.empty(0, dtype=np.float64)
+
+        is_valid = (from_stops >= 0) & (to_stops >= 0) & ~np.isnan(walk_times)
+        from_stops = from_stops[is_valid]
+        order = np.argsort(from_stops, kind="stable")
+
+        return (
+            np.r_[0, np.cumsum(np.bincount(from_stops, minlength=self.num_stops))],
+            to_stops[is_valid][order].astype(np.int32),
+            walk_times[is_valid][order].astype(np.float32),
+        )
+
+    def route_stop_ids(self, route: int) -> np.ndarray:
+        return self.route_stops[
+            self.route_stop_offsets[route] : self.route_stop_offsets[route + 1]
+        ]
+
+    def route_trip_ids(self, route: int) -> np.ndarray:
+        return self.route_trips[
+            self.route_trip_offsets[route] : self.route_trip_offsets[route + 1]
+        ]
+
+    def route_times(self, route: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Arrival and departure blocks of a route, shaped (stops, trips)."""
+        num_stops = self.route_stop_offsets[route + 1] - self.route_stop_offsets[route]
+        num_trips = self.route_trip_offsets[route + 1] - self.route_trip_offsets[route]
+        start = self.route_time_offsets[route]
+        end = start + num_stops * num_trips
+
+        return (
+            self.arrivals[start:end].reshape(num_stops, num_trips),
+            self.departures[start:end].reshape(num_stops, num_trips),
+        )
+
+    def routes_serving(self, stops: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Routes serving any of the given stops, with the earliest position served."""
+        starts = self.stop_route_offsets[stops]
+        counts = self.stop_route_offsets[stops + 1] - starts
+        if counts.sum() == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        idx = _expand_ranges(starts, counts)
+        routes = self.stop_routes[idx]
+        positions = self.stop_route_positions[idx]
+
+        # keep the earliest marked position for each route
+        order = np.lexsort((positions, routes))
+        routes = routes[order]
+        positions = positions[order]
+        first = np.r_[True, routes[1:] != routes[:-1]]
+
+        return routes[first], positions[first]
+
+
+def _expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Expand (start, count) ranges into the flat indices they cover."""
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+        counts.sum()
+    )
+
+
+def footpaths_from(
+    footpaths: Tuple[np.ndarray, np.ndarray, np.ndarray], stops: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Gather the footpaths leaving the given stops from a CSR adjacency.
+
+    :return: Arrays of (from stop, to stop, walk time)
+    """
+    offsets, to_stops, walk_times = footpaths
+    starts = offsets[stops]
+    counts = offsets[stops + 1] - starts
+
+    idx = _expand_ranges(starts, counts)
+    return np.repeat(stops, counts), to_stops[idx], walk_times[idx]
+
+
+def _fill_missing_times(stop_times: pd.DataFrame) -> pd.DataFrame:
+    stop_times["arrival_time"] = stop_times["arrival_time"].fillna(
+        stop_times["departure_time"]
+    )
+    stop_times["departure_time"] = stop_times["departure_time"].fillna(
+        stop_times["arrival_time"]
+    )
+
+    # Untimed stops get a time interpolated between the surrounding timepoints
+    if stop_times[["arrival_time", "departure_time"]].isna().any(axis=None):
+        for col in ["arrival_time", "departure_time"]:
+            stop_times[col] = stop_times.groupby("trip_id")[col].transform(
+                lambda x: x.interpolate(limit_direction="both")
+            )
+
+    return stop_times
+
+
+def _split_overtaking_trips(arrivals: np.ndarray, departures: np.ndarray) -> List:
+    """Split trips (sorted by first departure) into groups with no overtaking.
+
+    Binary search on a stop position only works if every position is sorted by time, so
+    a trip that passes another one on the same stop pattern goes into a separate route.
+    """
+    groups = []
+    for trip in range(arrivals.shape[1]):
+        for group in groups:
+            last = group[-1]
+            if np.all(departures[:, last] <= departures[:, trip]) and np.all(
+                arrivals[:, last] <= arrivals[:, trip]
+            ):
+                group.append(trip)
+                break
+        else:
+            groups.append([trip])
+
+    return groups
+
+
+def _concatenate(arrays: List[np.ndarray], dtype) -> np.ndarray:
+    return np.concatenate(arrays).astype(dtype) if arrays else np.empty(0, dtype)
+
+
+def compile_timetable(
+    feed,
+    transfers: Optional[pd.DataFrame] = None,
+    ids: Optional[FeedIds] = None,
+    service_ids: Optional[Iterable[str]] = None,
+) -> Timetable:
+    """Compile a partridge feed into a Timetable for RAPTOR queries.
+
+    :param feed: A Partridge GTFS datafeed
+    :param transfers: Footpaths between stops, defaults to the transfers of the feed
+    :param ids: The id dictionary of the feed, interned from the feed if not given
+    :param service_ids: Only compile the trips of these services, defaults to all
+        the trips of the feed
+    :return: The compiled timetable
+    """
+    tic = time.perf_counter()
+
+    if transfers is None:
+        transfers = feed.transfers
+    if ids is None:
+        ids = intern_feed_ids(feed)
+
+    service_trips = feed.trips
+    stop_times = feed.stop_times
+    if service_ids is not None:
+        service_trips = service_trips[
+            service_trips["service_id"].isin(list(service_ids))
+        ]
+        stop_times = stop_times[stop_times["trip_id"].isin(service_trips["trip_id"])]
+
+    stop_times = stop_times[
+        ["trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time"]
+    ].copy()
+    stop_times["stop_idx"] = ids.stops.codes(stop_times["stop_id"])
+    stop_times["trip_idx"] = ids.trips.codes(stop_times["trip_id"])
+    stop_times = stop_times.sort_values(["trip_idx", "stop_sequence"])
+    stop_times = _fill_missing_times(stop_times)
+
+    trip_routes = np.full(len(ids.trips), -1, dtype=np.int32)
+    trip_routes[ids.trips.codes(service_trips["trip_id"])] = ids.routes.codes(
+        service_trips["route_id"]
+    )
+
+    # Trips with an identical sequence of stops form a single pattern
+    patterns = stop_times.groupby("trip_idx", sort=True)["stop_idx"].agg(tuple)
+    pattern_codes, pattern_stops = pd.factorize(patterns)
+
+    # Position of the first stop time of each trip
+    trip_offsets = np.full(len(ids.trips), -1, dtype=np.int64)
+    trip_offsets[patterns.index] = np.r_[
+        0, np.cumsum(patterns.map(len).to_numpy())[:-1]
+    ]
+    all_arrivals = stop_times["arrival_time"].to_numpy(dtype=np.float64)
+    all_departures = stop_times["departure_time"].to_numpy(dtype=np.float64)
+
+    route_stops = []
+    route_trips = []
+    route_arrivals = []
+    route_departures = []
+
+    pattern_trips = pd.Series(patterns.index).groupby(pattern_codes)
+    for pattern, trips in pattern_trips:
+        trips = trips.to_numpy()
+        num_stops = len(pattern_stops[pattern])
+
+        rows = trip_offsets[trips][None, :] + np.arange(num_stops)[:, None]
+        arrivals = all_arrivals[rows]
+        departures = all_departures[rows]
+
+        order = np.lexsort((arrivals[-1], departures[0]))
+        trips, arrivals, departures = (
+            trips[order],
+            arrivals[:, order],
+            departures[:, order],
+        )
+
+        for group in _split_overtaking_trips(arrivals, departures):
+            route_stops.append(np.asarray(pattern_stops[pattern], dtype=np.int32))
+            route_trips.append(trips[group].astype(np.int32))
+            route_arrivals.append(arrivals[:, group].ravel())
+            route_departures.append(departures[:, group].ravel())
+
+    route_stop_counts = np.array([len(x) for x in route_stops], dtype=np.int64)
+    route_trip_counts = np.array([len(x) for x in route_trips], dtype=np.int64)
+
+    # Index of the routes serving each stop, along with the position of the stop
+    stop_routes = np.repeat(
+        np.arange(len(route_stops), dtype=np.int32), route_stop_counts
+    )
+    stop_route_positions = _concatenate(
+        [np.arange(count) for count in route_stop_counts], np.int32
+    )
+    flat_stops = _concatenate(route_stops, np.int32)
+    order = np.argsort(flat_stops, kind="stable")
+
+    timetable = Timetable(
+        ids=ids,
+        trip_routes=trip_routes,
+        route_stop_offsets=np.r_[0, np.cumsum(route_stop_counts)],
+        route_stops=flat_stops,
+        route_trip_offsets=np.r_[0, np.cumsum(route_trip_counts)],
+        route_trips=_concatenate(route_trips, np.int32),
+        route_time_offsets=np.r_[0, np.cumsum(route_stop_counts * route_trip_counts)],
+        arrivals=_concatenate(route_arrivals, np.float64),
+        departures=_concatenate(route_departures, np.float64),
+        stop_route_offsets=np.r_[
+            0, np.cumsum(np.bincount(flat_stops, minlength=len(ids.stops)))
+        ],
+        stop_routes=stop_routes[order],
+        stop_route_positions=stop_route_positions[order],
+        transfers=transfers,
+    )
+
+    toc = time.perf_counter()
+    logger.debug(
+        "Timetable with {} routes compiled in {:0.4f} seconds".format(
+            timetable.num_routes, toc - tic
+        )
+    )
+
+    return timetable
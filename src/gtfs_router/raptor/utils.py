@@ -5,9 +5,7 @@ from typing import List
 import pandas as pd
 from stop_access import StopAccessState
 
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.debug("utils")
+logger = logging.getLogger(__name__)
 
 
 def get_trip_ids_for_stop_new(
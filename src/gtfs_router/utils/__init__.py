@@ -1,3 +1,6 @@
-from .build_transfers import find_transfers
+from .build_transfers import find_transfers, iter_transfers
+from .feed_index import FeedIndex, feed_index
+from .ids import FeedIds, IdMap, intern_feed_ids
 from .misc import line_cutter, log_stop_information
-from .shape_dist_traveled import generate_shape_dist_traveled
+from .shape_dist_traveled import ShapeDistanceCache, generate_shape_dist_traveled
+from .shape_line import ShapeLine
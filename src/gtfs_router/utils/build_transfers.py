@@ -1,13 +1,15 @@
+import itertools
 import logging
 import os
-from typing import Optional
+import shutil
+import tempfile
+from typing import Iterator, Optional, Tuple
 
-import geopandas as gpd
 import numpy as np
 import pandas as pd
-from shapely.geometry import Point
 
 from gtfs_router import ALBERS_EQUAL_AREA_CONICAL_EPSG
+from gtfs_router.utils.ids import IdMap
 
 OVERWRITE = "overwrite"
 APPEND = "append"
@@ -21,22 +23,148 @@ DEFAULT_BUFFER_DISTANCE = 150
 # In the defaults setup, the walk speed is 55 meters / minute (slightly faster than 2mph)
 DEFAULT_WALK_SPEED = 55
 
+# Default width of the tiles stops are processed in when streaming transfers. With the
+# default projection this is 5 kilometers.
+DEFAULT_TILE_SIZE = 5000
+
+# Number of existing transfers read at a time when streaming transfers
+DEFAULT_READ_CHUNK_SIZE = 100000
+
+# Mean radius of the earth in meters, for great-circle distances
+EARTH_RADIUS = 6371008.8
+
 TRANSFER_HEADERS = ["from_stop_id", "to_stop_id", "transfer_type", "min_transfer_time"]
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logging.debug("Initialize Logger")
+logger = logging.getLogger(__name__)
+
+
+def _neighbour_pairs(
+    coords: np.ndarray, distance: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """All pairs of points within a distance of each other, using a uniform grid.
+
+    Points are binned into cells as wide as the search distance, so the neighbours
+    of a point can only be in its own cell or an adjacent one. Only those candidates
+    are measured, which scales with the number of points and pairs found rather
+    than with every pair of points.
+
+    :param coords: (points x dimensions) cartesian coordinates
+    :param distance: The search distance, in the units of the coordinates
+    :return: Positions of the from and to points, sorted, and their distance
+    """
+    num_points, num_dims = coords.shape
+    if num_points == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    # a single key per cell, leaving room around the grid for the adjacent cells
+    cell_size = distance if distance > 0 else 1.0
+    cells = np.floor((coords - coords.min(axis=0)) / cell_size).astype(np.int64) + 1
+    shape = cells.max(axis=0) + 2
+    strides = np.r_[np.cumprod(shape[::-1])[::-1][1:], 1].astype(np.int64)
+    keys = cells @ strides
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    from_idx = []
+    to_idx = []
+    dists = []
+    for offset in itertools.product([-1, 0, 1], repeat=num_dims):
+        neighbour_keys = keys + np.asarray(offset) @ strides
+        starts = np.searchsorted(sorted_keys, neighbour_keys, side="left")
+        counts = np.searchsorted(sorted_keys, neighbour_keys, side="right") - starts
+        if counts.sum() == 0:
+            continue
+
+        # expand the (start, count) ranges of the cells into pairs of points
+        from_points = np.repeat(np.arange(num_points), counts)
+        to_points = order[
+            np.repeat(starts - np.cumsum(counts) + counts, counts)
+            + np.arange(counts.sum())
+        ]
+
+        dist = np.sqrt(np.power(coords[from_points] - coords[to_points], 2).sum(axis=1))
+        keep = dist <= distance
+        from_idx.append(from_points[keep])
+        to_idx.append(to_points[keep])
+        dists.append(dist[keep])
+
+    from_idx = np.concatenate(from_idx)
+    to_idx = np.concatenate(to_idx)
+    dists = np.concatenate(dists)
+
+    order = np.lexsort((to_idx, from_idx))
+    return from_idx[order], to_idx[order], dists[order]
+
+
+def _sphere_coordinates(stops: pd.DataFrame) -> np.ndarray:
+    """(x, y, z) coordinates of the stops on a sphere the size of the earth, in meters.
+
+    Straight-line (chord) distances between these points only depend on the
+    great-circle distance, so they can be searched with the same grid as projected
+    coordinates.
+    """
+    if "stop_lat" in stops.columns and "stop_lon" in stops.columns:
+        lat = stops["stop_lat"].to_numpy(dtype=float)
+        lon = stops["stop_lon"].to_numpy(dtype=float)
+    else:
+        stops = stops.to_crs(epsg=4326)
+        lat = stops["geometry"].y.to_numpy(dtype=float)
+        lon = stops["geometry"].x.to_numpy(dtype=float)
+
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return EARTH_RADIUS * np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
 
 
-def find_transfers(
-    stops: pd.DataFrame,
-    distance: Optional[float] = DEFAULT_BUFFER_DISTANCE,
-    epsg: Optional[float] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
-    walk_speed: Optional[float] = DEFAULT_WALK_SPEED,
-) -> pd.DataFrame:
+def _chord_length(distance: float) -> float:
+    """Straight-line length between two points a great-circle distance apart."""
+    return 2 * EARTH_RADIUS * np.sin(min(distance / (2 * EARTH_RADIUS), np.pi / 2))
+
+
+def _great_circle_distance(chord: np.ndarray) -> np.ndarray:
+    """Haversine distance between two points from the chord between them."""
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / (2 * EARTH_RADIUS), 1))
+
+
+def _project_stops(
+    stops: pd.DataFrame, epsg: Optional[float] = ALBERS_EQUAL_AREA_CONICAL_EPSG
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Stop ids and their (x, y) coordinates in the given projection.
+
+    Without an epsg, the stops are placed on a sphere instead, with (x, y, z)
+    coordinates, and neither geopandas nor pyproj is needed.
+
+    Stops without coordinates, such as generic nodes and boarding areas, are left
+    out: they have no distance to any stop, and would stretch the search grid over
+    every other stop.
+    """
+    if "stop_lat" in stops.columns and "stop_lon" in stops.columns:
+        located = np.isfinite(stops["stop_lat"].to_numpy(dtype=float)) & np.isfinite(
+            stops["stop_lon"].to_numpy(dtype=float)
+        )
+        if not located.all():
+            stops = stops[located]
+
+    if epsg is None:
+        ids, coords = stops["stop_id"].to_numpy(), _sphere_coordinates(stops)
+    else:
+        ids, coords = _project_to_epsg(stops, epsg)
+
+    located = np.isfinite(coords).all(axis=1)
+    if not located.all():
+        ids, coords = ids[located], coords[located]
+    return ids, coords
+
+
+def _project_to_epsg(stops: pd.DataFrame, epsg: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Stop ids and their (x, y) coordinates in the given projection."""
+    import geopandas as gpd
+    from shapely.geometry import Point
 
     # If this is not a GeoDataFrame, create one, so we project to a cartesian system for easier distances
-    # TODO: Explore just doing all distances with haversine formula in polar coordinates
     if not isinstance(stops, gpd.GeoDataFrame):
         stops = gpd.GeoDataFrame(
             data=stops,
@@ -47,51 +175,52 @@ def find_transfers(
 
     # Project to cartesian system
     stops = stops.to_crs(epsg=epsg)
-    stops["x"] = stops["geometry"].x
-    stops["y"] = stops["geometry"].y
-
-    # Grab a copy of the stop_id, x, y
-    buffers = stops[["stop_id", "x", "y"]].values
-
-    # Build a dataframe that will effectively become the cross join
-    buffers = pd.DataFrame(
-        index=np.repeat(stops.index, len(stops.index)),
-        data=np.tile(buffers, (len(stops.index), 1)),
-        columns=["stop_id", "x", "y"],
-    )
 
-    # "Cross" Join the data
-    buffers = pd.merge(
-        stops[["stop_id", "geometry", "x", "y"]],
-        buffers,
-        left_index=True,
-        right_index=True,
-        suffixes=["", "_potential"],
+    return (
+        stops["stop_id"].to_numpy(),
+        np.column_stack(
+            [
+                stops["geometry"].x.to_numpy(dtype=float),
+                stops["geometry"].y.to_numpy(dtype=float),
+            ]
+        ),
     )
 
-    # Figure out the euclidean distance between all the points
-    buffers["dist"] = np.sqrt(
-        (
-            np.power(buffers["x"] - buffers["x_potential"], 2)
-            + np.power(buffers["y"] - buffers["y_potential"], 2)
-        ).astype(float)
-    )
 
-    # Filter where the from = to and distances are greater than the threshold
-    stop_id_filter = buffers["stop_id"] != buffers["stop_id_potential"]
-    distance_filter = buffers["dist"] <= distance
-    buffers = buffers[distance_filter & stop_id_filter].copy()
-
-    # Calculate the walk time in seconds
-    buffers["walk_time"] = (buffers["dist"] / walk_speed) * 60
-
-    # Retain the stuff needed
-    buffers = buffers[["stop_id", "stop_id_potential", "walk_time"]].copy()
-    buffers = buffers.rename(
-        columns={
-            "stop_id": "from_stop_id",
-            "stop_id_potential": "to_stop_id",
-            "walk_time": "min_transfer_time",
+def _transfers_within(
+    stop_ids: IdMap,
+    codes: np.ndarray,
+    coords: np.ndarray,
+    distance: float,
+    walk_speed: float,
+    from_stops: Optional[np.ndarray] = None,
+    great_circle: Optional[bool] = False,
+) -> pd.DataFrame:
+    """Transfers between the stops within the threshold distance of each other.
+
+    :param from_stops: Only keep transfers from the stops at these positions
+    :param great_circle: The coordinates are on a sphere, and the distance is along
+        its surface
+    """
+
+    # Find the pairs of stops within the threshold distance of each other
+    if great_circle:
+        from_idx, to_idx, dist = _neighbour_pairs(coords, _chord_length(distance))
+        dist = _great_circle_distance(dist)
+    else:
+        from_idx, to_idx, dist = _neighbour_pairs(coords, distance)
+
+    # Filter where the from = to
+    keep = (codes[from_idx] != codes[to_idx]) & (dist <= distance)
+    if from_stops is not None:
+        keep &= np.isin(from_idx, from_stops)
+
+    # Calculate the walk time in seconds, and retain the stuff needed
+    buffers = pd.DataFrame(
+        data={
+            "from_stop_id": stop_ids.to_ids(codes[from_idx[keep]]),
+            "to_stop_id": stop_ids.to_ids(codes[to_idx[keep]]),
+            "min_transfer_time": (dist[keep] / walk_speed) * 60,
         }
     )
 
@@ -102,13 +231,222 @@ def find_transfers(
     return buffers[TRANSFER_HEADERS]
 
 
+def find_transfers(
+    stops: pd.DataFrame,
+    distance: Optional[float] = DEFAULT_BUFFER_DISTANCE,
+    epsg: Optional[float] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
+    walk_speed: Optional[float] = DEFAULT_WALK_SPEED,
+) -> pd.DataFrame:
+    """Find walking transfers between every pair of stops within a distance.
+
+    :param stops: The stops, as a GeoDataFrame or with stop_lat and stop_lon columns
+    :param distance: Largest distance between two stops, in projection units
+    :param epsg: The projection distances are measured in. With None, great-circle
+        (haversine) distances in meters are computed directly on the stop_lat and
+        stop_lon columns, without reprojecting.
+    :param walk_speed: Walk speed, in projection units per minute
+    :return: The transfers, with the TRANSFER_HEADERS columns
+    """
+    ids, coords = _project_stops(stops, epsg)
+
+    # Work with integer codes for the stop ids, only translating back for output
+    stop_ids = IdMap(ids)
+    codes = stop_ids.codes(ids)
+
+    return _transfers_within(
+        stop_ids, codes, coords, distance, walk_speed, great_circle=epsg is None
+    )
+
+
+def iter_transfers(
+    stops: pd.DataFrame,
+    distance: Optional[float] = DEFAULT_BUFFER_DISTANCE,
+    epsg: Optional[float] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
+    walk_speed: Optional[float] = DEFAULT_WALK_SPEED,
+    tile_size: Optional[float] = DEFAULT_TILE_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """Find transfers one square tile of stops at a time.
+
+    Each tile yields the transfers from the stops inside it, searching the stops of
+    the tile and those within the threshold distance of its edges. Together the
+    tiles hold the same transfers as find_transfers, but only one tile of transfers
+    is in memory at a time.
+
+    :param tile_size: Width of the tiles, in projection units (meters without an
+        epsg, where the tiles are cubes around the stops on the sphere)
+    """
+    ids, coords = _project_stops(stops, epsg)
+    stop_ids = IdMap(ids)
+    codes = stop_ids.codes(ids)
+
+    tiles = np.floor(coords / tile_size).astype(np.int64)
+    tile_keys, tile_of_stop = np.unique(tiles, axis=0, return_inverse=True)
+    tile_of_stop = tile_of_stop.ravel()
+
+    # stops sorted by x, so the stops near a tile can be found by binary search
+    x_order = np.argsort(coords[:, 0], kind="stable")
+    sorted_x = coords[x_order, 0]
+
+    for tile, tile_key in enumerate(tile_keys):
+        lower = tile_key * tile_size - distance
+        upper = (tile_key + 1) * tile_size + distance
+
+        nearby = x_order[
+            np.searchsorted(sorted_x, lower[0], side="left") : np.searchsorted(
+                sorted_x, upper[0], side="right"
+            )
+        ]
+        nearby = np.sort(
+            nearby[
+                np.all((coords[nearby] >= lower) & (coords[nearby] <= upper), axis=1)
+            ]
+        )
+
+        yield _transfers_within(
+            stop_ids,
+            codes[nearby],
+            coords[nearby],
+            distance,
+            walk_speed,
+            from_stops=np.flatnonzero(tile_of_stop[nearby] == tile),
+            great_circle=epsg is None,
+        )
+
+
+def _pair_keys(stop_ids: IdMap, transfers: pd.DataFrame) -> np.ndarray:
+    """A single integer per (from, to) pair of stops, -1 if either stop is unknown."""
+    from_codes = stop_ids.codes(transfers["from_stop_id"]).astype(np.int64)
+    to_codes = stop_ids.codes(transfers["to_stop_id"]).astype(np.int64)
+    return np.where(
+        (from_codes >= 0) & (to_codes >= 0), from_codes * len(stop_ids) + to_codes, -1
+    )
+
+
+def _write_transfers(
+    out,
+    transfers_path: str,
+    stops: pd.DataFrame,
+    append: bool,
+    distance: float,
+    epsg: float,
+    walk_speed: float,
+    tile_size: float,
+) -> int:
+    """Write the existing transfers and those of each tile to an open file.
+
+    :return: The number of transfers written
+    """
+    stop_ids = IdMap(stops["stop_id"])
+    existing_keys = np.empty(0, dtype=np.int64)
+    unknown_pairs = set()
+    num_transfers = 0
+
+    pd.DataFrame(columns=TRANSFER_HEADERS).to_csv(out, index=False)
+
+    if append:
+        for existing_transfers in pd.read_csv(
+            transfers_path,
+            dtype={"from_stop_id": str, "to_stop_id": str},
+            chunksize=DEFAULT_READ_CHUNK_SIZE,
+        ):
+            # Make sure the optional fields are available.
+            for optional_col in ["transfer_type", "min_transfer_time"]:
+                if optional_col not in existing_transfers.columns:
+                    existing_transfers[optional_col] = np.nan
+
+            # Existing transfers take precedence, the first of duplicates is kept
+            keys = _pair_keys(stop_ids, existing_transfers)
+            is_duplicate = (keys >= 0) & (
+                np.isin(keys, existing_keys) | pd.Series(keys).duplicated().to_numpy()
+            )
+            existing_keys = np.union1d(existing_keys, keys[keys >= 0])
+
+            # Transfers between stops missing from stops.txt are rare, and cannot
+            # be duplicated by new ones, so they are only checked among themselves
+            for row in np.flatnonzero(keys < 0):
+                pair = (
+                    existing_transfers["from_stop_id"].iat[row],
+                    existing_transfers["to_stop_id"].iat[row],
+                )
+                is_duplicate[row] = pair in unknown_pairs
+                unknown_pairs.add(pair)
+
+            existing_transfers[~is_duplicate][TRANSFER_HEADERS].to_csv(
+                out, header=False, index=False, float_format="%.1f"
+            )
+            num_transfers += (~is_duplicate).sum()
+
+    for transfers in iter_transfers(stops, distance, epsg, walk_speed, tile_size):
+        transfers = transfers[~np.isin(_pair_keys(stop_ids, transfers), existing_keys)]
+        transfers.to_csv(out, header=False, index=False, float_format="%.1f")
+        num_transfers += len(transfers)
+
+    return num_transfers
+
+
+def _stream_transfers(
+    gtfs_path: str,
+    stops: pd.DataFrame,
+    append: bool,
+    distance: float,
+    epsg: float,
+    walk_speed: float,
+    tile_size: float,
+):
+    """Write transfers.txt one chunk of existing transfers and one tile at a time."""
+    transfers_path = os.path.join(gtfs_path, "transfers.txt")
+
+    # a temporary file of its own, so concurrent runs never write to each other's,
+    # and transfers.txt is only replaced once every tile is written
+    out = tempfile.NamedTemporaryFile(
+        "w",
+        newline="",
+        dir=gtfs_path,
+        prefix="transfers.",
+        suffix=".tmp",
+        delete=False,
+    )
+    try:
+        with out:
+            num_transfers = _write_transfers(
+                out,
+                transfers_path,
+                stops,
+                append,
+                distance,
+                epsg,
+                walk_speed,
+                tile_size,
+            )
+        # the temporary file is only readable by its owner, unlike the rest of the feed
+        shutil.copymode(os.path.join(gtfs_path, "stops.txt"), out.name)
+        os.replace(out.name, transfers_path)
+    finally:
+        if os.path.exists(out.name):
+            os.remove(out.name)
+
+    logger.info("{} transfers written to {}".format(num_transfers, transfers_path))
+
+
 def update_transfers(
     gtfs_path: str,
     write_type: Optional[str] = NO_OVERWRITE,
     distance: Optional[float] = DEFAULT_BUFFER_DISTANCE,
     epsg: Optional[float] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
     walk_speed: Optional[float] = DEFAULT_WALK_SPEED,
+    tile_size: Optional[float] = None,
 ):
+    """Write walking transfers between nearby stops to the transfers.txt of a feed.
+
+    By default all transfers are built in memory and written at once. With a
+    tile_size, stops are processed in square tiles of that width (in projection
+    units) and transfers are written as each tile is done, while existing
+    transfers are streamed through and deduplicated on their (from, to) stop pair,
+    so memory is bounded by the tile size rather than the size of the feed.
+
+    With epsg None, distances are great-circle distances in meters, computed on the
+    stop_lat and stop_lon columns of stops.txt without reprojecting.
+    """
 
     # Check to see if the transfer.txt file already exists
     xfer_file_exists = os.path.exists(os.path.join(gtfs_path, "transfers.txt"))
@@ -131,15 +469,30 @@ def update_transfers(
                 )
             )
 
-    # Read in the stops
-    stops = pd.read_csv(os.path.join(gtfs_path, "stops.txt"))
+    # Read in the stops, keeping the ids as they are written
+    stops = pd.read_csv(os.path.join(gtfs_path, "stops.txt"), dtype={"stop_id": str})
+
+    if tile_size is not None:
+        _stream_transfers(
+            gtfs_path,
+            stops,
+            xfer_file_exists and write_type == APPEND,
+            distance,
+            epsg,
+            walk_speed,
+            tile_size,
+        )
+        return
 
     # Get all possible transfers between stops within threshold distance
     transfers = find_transfers(stops, distance, epsg, walk_speed)
 
     # if append, read in the existing file and add new records
     if xfer_file_exists and write_type == APPEND:
-        existing_transfers = pd.read_csv(os.path.join(gtfs_path, "transfers.txt"))
+        existing_transfers = pd.read_csv(
+            os.path.join(gtfs_path, "transfers.txt"),
+            dtype={"from_stop_id": str, "to_stop_id": str},
+        )
 
         # Make sure the optional fields are available.
         for optional_col in ["transfer_type", "min_transfer_time"]:
@@ -147,16 +500,21 @@ def update_transfers(
                 existing_transfers[optional_col] = np.nan
 
         transfers = pd.concat(
-            existing_transfers[TRANSFER_HEADERS], transfers[TRANSFER_HEADERS]
-        )
-        transfers = transfers.drop_duplicates(
-            subset=["from_stop_id", "to_stop_id"], keep="first"
+            [existing_transfers[TRANSFER_HEADERS], transfers[TRANSFER_HEADERS]],
+            ignore_index=True,
         )
 
-    # Cast variables just to make sure
-    transfers[["to_stop_id", "from_stop_id"]] = (
-        transfers[["to_stop_id", "from_stop_id"]].astype(int).astype(str)
-    )
+        # Existing transfers take precedence, compared on the interned stop ids
+        stop_ids = IdMap(
+            pd.concat([transfers["from_stop_id"], transfers["to_stop_id"]])
+        )
+        pairs = pd.DataFrame(
+            {
+                "from_stop": stop_ids.codes(transfers["from_stop_id"]),
+                "to_stop": stop_ids.codes(transfers["to_stop_id"]),
+            }
+        )
+        transfers = transfers[~pairs.duplicated(keep="first").to_numpy()]
 
     # Export to disk
     transfers.to_csv(
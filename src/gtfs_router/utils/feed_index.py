@@ -0,0 +1,135 @@
+import weakref
+from typing import Callable, Tuple
+
+import numpy as np
+import pandas as pd
+
+from gtfs_router.utils.shape_line import ShapeLine
+
+# One index per feed, dropped along with the feed
+_feed_indexes = weakref.WeakKeyDictionary()
+
+
+class FeedIndex:
+    def __init__(self, feed):
+        """Hashed lookups into the tables of a partridge feed.
+
+        Stops are indexed by stop_id, trips by trip_id and stop times by (trip_id,
+        position), the position of the stop time in its trip by stop_sequence, which
+        matches the stop positions of the compiled routes. Shapes projected to an epsg, their
+        cumulative distances and the transformer from that epsg back to lat/lon are
+        built on first use and kept for later itineraries.
+
+        Only a weak reference to the feed is kept, so the index, which is cached
+        against the feed, does not keep it alive.
+        """
+        self._feed = weakref.ref(feed)
+
+        self.stops = feed.stops.drop_duplicates("stop_id").set_index("stop_id")
+        self.trips = feed.trips.drop_duplicates("trip_id").set_index("trip_id")
+        self.routes = feed.routes.drop_duplicates("route_id").set_index("route_id")
+        stop_times = feed.stop_times.sort_values(["trip_id", "stop_sequence"])
+        self.stop_times = stop_times.set_index(
+            [stop_times["trip_id"], stop_times.groupby("trip_id").cumcount()]
+        ).rename_axis(["trip_id", "position"])
+
+        self._stop_coordinates = None
+        self._shapes = {}
+        self._shape_lines = {}
+        self._transformers = {}
+
+    def stop(self, stop_id: str) -> pd.Series:
+        return self.stops.loc[stop_id]
+
+    def trip(self, trip_id: str) -> pd.Series:
+        return self.trips.loc[trip_id]
+
+    def route(self, route_id: str) -> pd.Series:
+        return self.routes.loc[route_id]
+
+    def stop_time(self, trip_id: str, position: int) -> pd.Series:
+        return self.stop_times.loc[(trip_id, position)]
+
+    def stop_rows(self, stop_ids) -> np.ndarray:
+        """Row positions of many stops in the stops table, -1 for unknown stops."""
+        return self.stops.index.get_indexer(stop_ids)
+
+    def trip_rows(self, trip_ids) -> np.ndarray:
+        return self.trips.index.get_indexer(trip_ids)
+
+    def route_rows(self, route_ids) -> np.ndarray:
+        return self.routes.index.get_indexer(route_ids)
+
+    def stop_time_rows(self, trip_ids, positions) -> np.ndarray:
+        """Row positions of many (trip_id, position) stop times in the stop times table.
+
+        :raises KeyError: If a trip has no stop time at the position
+        """
+        rows = self.stop_times.index.get_indexer(
+            pd.MultiIndex.from_arrays([trip_ids, positions])
+        )
+        if (rows < 0).any():
+            missing = np.flatnonzero(rows < 0)[0]
+            raise KeyError((trip_ids[missing], positions[missing]))
+        return rows
+
+    def stop_coordinates(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Longitude and latitude of the stops, in the order of the stops table.
+
+        Read from stop_lon and stop_lat, or from the point geometries of a feed loaded
+        with partridge.load_geo_feed.
+        """
+        if self._stop_coordinates is None:
+            if "geometry" in self.stops.columns:
+                self._stop_coordinates = (
+                    self.stops.geometry.x.to_numpy(),
+                    self.stops.geometry.y.to_numpy(),
+                )
+            else:
+                self._stop_coordinates = (
+                    pd.to_numeric(self.stops["stop_lon"]).to_numpy(dtype=float),
+                    pd.to_numeric(self.stops["stop_lat"]).to_numpy(dtype=float),
+                )
+
+        return self._stop_coordinates
+
+    def shape(self, shape_id: str, epsg: int):
+        """Geometry of a shape, projected to the epsg."""
+        if epsg not in self._shapes:
+            feed = self._feed()
+            if feed is None:
+                raise ReferenceError("The feed of this index was garbage collected")
+
+            shapes = feed.shapes.to_crs(epsg=epsg)
+            self._shapes[epsg] = shapes.drop_duplicates("shape_id").set_index(
+                "shape_id"
+            )["geometry"]
+
+        return self._shapes[epsg].loc[shape_id]
+
+    def shape_line(self, shape_id: str, epsg: int) -> ShapeLine:
+        """Cumulative distances along a shape projected to the epsg, for cutting it."""
+        if (shape_id, epsg) not in self._shape_lines:
+            self._shape_lines[(shape_id, epsg)] = ShapeLine.from_line(
+                self.shape(shape_id, epsg)
+            )
+
+        return self._shape_lines[(shape_id, epsg)]
+
+    def to_lat_lon(self, epsg: int) -> Callable:
+        """Transform from the epsg to lat/lon (EPSG:4326), for shapely.ops.transform."""
+        if epsg not in self._transformers:
+            import pyproj
+
+            self._transformers[epsg] = pyproj.Transformer.from_crs(
+                pyproj.CRS.from_epsg(epsg), pyproj.CRS("EPSG:4326"), always_xy=True
+            ).transform
+
+        return self._transformers[epsg]
+
+
+def feed_index(feed) -> FeedIndex:
+    """The FeedIndex of a feed, built the first time it is asked for."""
+    if feed not in _feed_indexes:
+        _feed_indexes[feed] = FeedIndex(feed)
+    return _feed_indexes[feed]
@@ -0,0 +1,48 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+
+class IdMap:
+    def __init__(self, ids: Iterable):
+        """Dense int32 codes for a set of GTFS ids, in the order given."""
+        self.ids = np.asarray(pd.unique(pd.Series(ids, dtype=object)))
+        self._index = pd.Index(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, gtfs_id) -> bool:
+        return gtfs_id in self._index
+
+    def codes(self, ids) -> np.ndarray:
+        """Codes for the given ids, or -1 for ids that are not in the map."""
+        return self._index.get_indexer(ids).astype(np.int32)
+
+    def code(self, gtfs_id) -> int:
+        return int(self.codes([gtfs_id])[0])
+
+    def to_ids(self, codes) -> np.ndarray:
+        return self.ids[codes]
+
+
+class FeedIds:
+    def __init__(self, stops: IdMap, trips: IdMap, routes: IdMap):
+        """Integer codes for the stop, trip and route ids of a feed.
+
+        Ids are interned once when a feed is loaded. Joins, masks and state arrays
+        work on the codes, and ids are only translated back to strings for output.
+        """
+        self.stops = stops
+        self.trips = trips
+        self.routes = routes
+
+
+def intern_feed_ids(feed) -> FeedIds:
+    """Build the id dictionary of a partridge feed."""
+    return FeedIds(
+        stops=IdMap(pd.concat([feed.stops["stop_id"], feed.stop_times["stop_id"]])),
+        trips=IdMap(pd.concat([feed.trips["trip_id"], feed.stop_times["trip_id"]])),
+        routes=IdMap(pd.concat([feed.routes["route_id"], feed.trips["route_id"]])),
+    )
@@ -1,6 +1,6 @@
 import logging
 
-logger = logging.getLogger()
+logger = logging.getLogger(__name__)
 
 
 def log_stop_information(partridge_feed, stop_id):
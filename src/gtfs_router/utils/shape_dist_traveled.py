@@ -1,166 +1,164 @@
+import hashlib
 import logging
-from typing import Optional
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
 
-import geopandas as gpd
 import numpy as np
 import pandas as pd
 
 from gtfs_router import ALBERS_EQUAL_AREA_CONICAL_EPSG
-from gtfs_router.utils import line_cutter
+from gtfs_router.utils.shape_line import ShapeLine
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logging.debug("Initialize Logger")
+logger = logging.getLogger(__name__)
 
 
 SHAPE_DIST_TRAVELED = "shape_dist_traveled"
 
+# Default number of stop patterns handed to a worker at a time
+DEFAULT_CHUNK_SIZE = 64
 
-def _get_trip_types(stop_times: pd.DataFrame, trips: pd.DataFrame) -> pd.DataFrame:
-    trip_types = pd.concat(
-        [
-            stop_times.groupby("trip_id")["stop_id"].apply(lambda x: ",".join(list(x))),
-            stop_times.groupby("trip_id")["stop_sequence"].apply(
-                lambda x: ",".join(str(seq) for seq in x)
-            ),
-        ],
-        axis=1,
-        keys=["stop_id", "stop_sequence"],
-    ).reset_index()
-
-    trip_types = pd.merge(
-        trip_types, trips[["trip_id", "route_id", "shape_id"]], on="trip_id"
-    )
-    return (
-        trip_types.groupby(["route_id", "shape_id", "stop_id", "stop_sequence"])[
-            "trip_id"
-        ]
-        .apply(lambda x: ",".join(list(x)))
-        .reset_index()
-    )
-
-
-def _find_distances(
-    trip_types: pd.DataFrame, shapes: gpd.GeoDataFrame, stops: gpd.GeoDataFrame
-):
-    _trip_types = trip_types.copy()
-    _trip_types[SHAPE_DIST_TRAVELED] = None
-
-    counter = 1
-    total_rows = len(_trip_types)
-
-    for trip_idx, trip_type in _trip_types.iterrows():
-        if counter % 10 == 0:
-            logger.info(
-                "Processing Unique Trip Group {} of {}".format(counter, total_rows)
-            )
-
-        counter = counter + 1
-
-        line = shapes[shapes["shape_id"] == trip_type["shape_id"]]["geometry"].values[0]
+# Shape lines shared by the patterns measured in a worker process
+_worker_state = {}
 
-        trip_stops = trip_type["stop_id"].split(",")
+# Bumped whenever the way distances are measured changes, invalidating cached results
+CACHE_VERSION = 1
 
-        dist_traveled = []
 
-        dist = 0
+class ShapeDistanceCache:
+    def __init__(self, cache_dir: str):
+        """Stop distances of shape patterns, kept on disk across feed versions.
 
-        for trip_stop in trip_stops:
-            stop = stops[stops["stop_id"] == trip_stop]["geometry"].values[0]
-            proj_dist = line.project(stop)
-            _line = line_cutter(line, proj_dist)
-            ## FIXME: This is a hack, some loops in routes cause problems
-            if _line is None:
-                logger.warning("Potential Error Calculating Distances")
-                logger.warning("Idx Error: {}".format(trip_idx))
-                logger.warning("Stop ID Error: {}".format(trip_stop))
-            else:
-                line = _line[-1]
-            dist = proj_dist + dist
+        Each pattern is keyed by a hash of its projected shape coordinates, the
+        coordinates of its stops in order and the epsg, so a pattern left unchanged by
+        a new feed is read back instead of measured again. hits and misses count the
+        lookups since the cache was opened.
 
-            dist_traveled.append(dist)
+        :param cache_dir: Directory the distances are written to, created if needed
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
 
-            if line is None:
-                print("Idx Error: {}".format(trip_idx))
-                print("Stop ID Error: {}".format(trip_type["stop_id"]))
-                break
+        self.hits = 0
+        self.misses = 0
 
-        trip_type[SHAPE_DIST_TRAVELED] = dist_traveled
-
-    return _trip_types
-
-
-def _expand_trip_types(trip_types: pd.DataFrame) -> pd.DataFrame:
-    trip_dict = []
-
-    for idx, trip_type in trip_types.iterrows():
-        stop_ids = trip_type["stop_id"].split(",")
-        stop_seq = trip_type["stop_sequence"].split(",")
-        dist_traveled = trip_type[SHAPE_DIST_TRAVELED]
-
-        assert len(stop_ids) == (len(dist_traveled))
-        trip_dict.append(
-            pd.DataFrame(
-                data={
-                    "route_id": [trip_type.route_id] * len(stop_ids),
-                    "trip_id": [trip_type.trip_id] * len(stop_ids),
-                    "stop_id": stop_ids,
-                    "stop_sequence": stop_seq,
-                    SHAPE_DIST_TRAVELED: dist_traveled,
-                }
-            )
+    @staticmethod
+    def key(shape_coords: np.ndarray, stop_coords: np.ndarray, epsg: int) -> str:
+        digest = hashlib.sha1(
+            "{}:{}:{}:{}".format(
+                CACHE_VERSION, epsg, len(shape_coords), len(stop_coords)
+            ).encode()
         )
+        digest.update(np.ascontiguousarray(shape_coords, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(stop_coords, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "{}.npy".format(key))
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """The cached distances of a pattern, or None if it was never measured."""
+        try:
+            distances = np.load(self._path(key))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return distances
+
+    def put(self, key: str, distances: np.ndarray):
+        # written to a temporary file first, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npy.tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, distances)
+        os.replace(tmp_path, self._path(key))
+
+
+def _get_trip_patterns(
+    stop_times: pd.DataFrame, trips: pd.DataFrame
+) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Group trips running the same shape through the same sequence of stops.
+
+    :param stop_times: Stop times sorted by trip_id and stop_sequence
+    :param trips: The trips table
+    :return: The pattern of every trip, in the order of the stop times, and the
+        shape_id and stop_ids of every pattern
+    """
+    trip_stops = stop_times.groupby("trip_id", sort=False)["stop_id"].agg(tuple)
+    shape_ids = (
+        trips.drop_duplicates("trip_id")
+        .set_index("trip_id")["shape_id"]
+        .reindex(trip_stops.index)
+    )
 
-    trip_dict = pd.concat(trip_dict)
-
-    trip_dict[["trip_id", "stop_id"]] = trip_dict[["trip_id", "stop_id"]].astype(str)
-    trip_dict["stop_sequence"] = trip_dict["stop_sequence"].astype(int)
-
-    return trip_dict
-
+    pattern_of_trip, patterns = pd.factorize(
+        pd.Series(
+            list(zip(shape_ids.to_numpy(), trip_stops.to_numpy())), dtype=object
+        ).to_numpy()
+    )
 
-def _generate_new_trip_table(trip_types: pd.DataFrame) -> pd.DataFrame:
-    trip_table = []
+    return pattern_of_trip, pd.DataFrame(
+        list(patterns), columns=["shape_id", "stop_id"]
+    )
 
-    for (route, trips), gb in trip_types.groupby(["route_id", "trip_id"]):
-        num_trips = len(trips.split(","))
 
-        trip_ids = np.repeat(trips.split(","), len(gb))
+def _init_worker(shape_lines: Dict[str, ShapeLine]):
+    _worker_state["shape_lines"] = shape_lines
 
-        route_ids = np.repeat(route, len(gb) * num_trips)
 
-        stop_ids = np.tile(gb["stop_id"], num_trips)
+def _find_distances(pattern: Tuple[str, np.ndarray]) -> np.ndarray:
+    """Distance along the shape of a pattern to each of its stops.
 
-        stop_seq = np.tile(gb["stop_sequence"], num_trips)
+    Each stop is projected onto the shape after the previous stop, so loops in a
+    route are passed in order. Stops without coordinates get no distance.
+    """
+    shape_id, stop_coords = pattern
+    line = _worker_state["shape_lines"].get(shape_id)
 
-        dist_traveled = np.tile(gb[SHAPE_DIST_TRAVELED], num_trips)
+    distances = np.full(len(stop_coords), np.nan)
+    if line is None:
+        return distances
 
-        trip_table.append(
-            pd.DataFrame(
-                data={
-                    "route_id": route_ids,
-                    "trip_id": trip_ids,
-                    "stop_id": stop_ids,
-                    "stop_sequence": stop_seq,
-                    SHAPE_DIST_TRAVELED: dist_traveled,
-                }
-            )
-        )
+    dist = 0.0
+    for i, (x, y) in enumerate(stop_coords):
+        if np.isnan(x) or np.isnan(y):
+            continue
+        dist = line.project(x, y, start=dist)
+        distances[i] = dist
 
-    return pd.concat(trip_table)
+    return distances
 
 
 def generate_shape_dist_traveled(
     gtfs_feed: pd.DataFrame,
     epsg: Optional[int] = ALBERS_EQUAL_AREA_CONICAL_EPSG,
     overwrite: Optional[bool] = False,
+    workers: Optional[int] = None,
+    chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    cache: Optional[ShapeDistanceCache] = None,
 ) -> pd.DataFrame:
-    """
+    """Measure the distance along the trip shape to every stop time.
+
+    Trips running the same shape through the same stops are measured once, across a
+    pool of worker processes, and the distances are spread back onto the stop times
+    of every trip of the pattern.
 
     :param gtfs_feed: A Partridge GTFS datafeed
-    :param overwrite:
-    :return:
+    :param epsg: Projection the distances are measured in
+    :param overwrite: Measure the distances even if the feed already has them
+    :param workers: Number of worker processes, defaults to the number of CPUs. With
+        a single worker the patterns are measured in this process.
+    :param chunk_size: Number of patterns sent to a worker at a time
+    :param cache: Distances of patterns measured before, only the patterns missing
+        from it are measured and then added to it
+    :return: The stop times, sorted by trip_id and stop_sequence, with a
+        shape_dist_traveled column
     """
+    tic = time.perf_counter()
+
     shapes = gtfs_feed.shapes.to_crs(epsg=epsg)
     stops = gtfs_feed.stops.to_crs(epsg=epsg)
     stop_times = gtfs_feed.stop_times.sort_values(["trip_id", "stop_sequence"])
@@ -175,15 +173,90 @@ def generate_shape_dist_traveled(
         )
         return
 
-    trip_types = _get_trip_types(stop_times, trips)
-    trip_types = _find_distances(trip_types, shapes, stops)
-    trip_types = _expand_trip_types(trip_types)
-    trip_table = _generate_new_trip_table(trip_types)
+    pattern_of_trip, patterns = _get_trip_patterns(stop_times, trips)
 
-    assert len(trip_table) == len(stop_times)
+    shape_lines = {
+        shape_id: ShapeLine.from_line(line)
+        for shape_id, line in shapes.drop_duplicates("shape_id")[
+            ["shape_id", "geometry"]
+        ].itertuples(index=False, name=None)
+    }
 
-    return pd.merge(
-        stop_times,
-        trip_table[["trip_id", "stop_id", "stop_sequence", SHAPE_DIST_TRAVELED]],
-        on=["trip_id", "stop_id", "stop_sequence"],
+    # stop coordinates of every pattern, NaN for stops missing from stops.txt
+    stops = stops.drop_duplicates("stop_id")
+    stop_xy = np.vstack(
+        [
+            np.column_stack([stops.geometry.x.to_numpy(), stops.geometry.y.to_numpy()]),
+            [np.nan, np.nan],
+        ]
     )
+    stop_rows = pd.Index(stops["stop_id"])
+    tasks = [
+        (shape_id, stop_xy[stop_rows.get_indexer(stop_ids)])
+        for shape_id, stop_ids in patterns[["shape_id", "stop_id"]].itertuples(
+            index=False, name=None
+        )
+    ]
+
+    distances = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    if cache is not None:
+        for i, (shape_id, stop_coords) in enumerate(tasks):
+            if shape_id in shape_lines:
+                keys[i] = cache.key(shape_lines[shape_id].coords, stop_coords, epsg)
+                distances[i] = cache.get(keys[i])
+    to_measure = [i for i, pattern in enumerate(distances) if pattern is None]
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1:
+        _init_worker(shape_lines)
+        measured = [_find_distances(tasks[i]) for i in to_measure]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(shape_lines,)
+        ) as executor:
+            measured = list(
+                executor.map(
+                    _find_distances,
+                    [tasks[i] for i in to_measure],
+                    chunksize=chunk_size,
+                )
+            )
+
+    for i, pattern in zip(to_measure, measured):
+        distances[i] = pattern
+        if keys[i] is not None:
+            cache.put(keys[i], pattern)
+
+    if cache is not None:
+        logger.info(
+            "{} patterns read from the cache, {} measured".format(
+                len(tasks) - len(to_measure), len(to_measure)
+            )
+        )
+
+    num_missing = sum(shape_id not in shape_lines for shape_id in patterns["shape_id"])
+    if num_missing:
+        logger.warning("{} patterns have no shape".format(num_missing))
+
+    # spread the distances of each pattern onto the stop times of its trips
+    pattern_lengths = np.array([len(pattern) for pattern in distances], dtype=np.int64)
+    pattern_offsets = np.cumsum(pattern_lengths) - pattern_lengths
+    pattern_of_rows = np.repeat(pattern_of_trip, pattern_lengths[pattern_of_trip])
+    stop_positions = stop_times.groupby("trip_id", sort=False).cumcount().to_numpy()
+
+    stop_times = stop_times.reset_index(drop=True)
+    stop_times[SHAPE_DIST_TRAVELED] = np.concatenate([np.empty(0)] + distances)[
+        pattern_offsets[pattern_of_rows] + stop_positions
+    ]
+
+    toc = time.perf_counter()
+    logger.info(
+        "Distances of {} trips in {} patterns measured in {:0.4f} seconds".format(
+            len(pattern_of_trip), len(patterns), toc - tic
+        )
+    )
+
+    return stop_times
@@ -0,0 +1,114 @@
+from typing import Optional
+
+import numpy as np
+
+
+class ShapeLine:
+    def __init__(self, coords):
+        """Vertices of a shape and the distance along it to each vertex.
+
+        Cutting the shape between two distances is a binary search on the cumulative
+        distances and an interpolation, instead of projecting every vertex with
+        shapely.
+
+        :param coords: (n, 2) array of vertex coordinates, in a projected crs
+        """
+        self.coords = np.asarray(coords, dtype=float).reshape(len(coords), -1)[:, :2]
+        self.distances = np.concatenate(
+            [[0.0], np.cumsum(np.hypot(*np.diff(self.coords, axis=0).T))]
+        )
+
+    @classmethod
+    def from_line(cls, line) -> "ShapeLine":
+        """ShapeLine of a shapely LineString."""
+        return cls(np.asarray(line.coords))
+
+    @property
+    def length(self) -> float:
+        return self.distances[-1]
+
+    def interpolate(self, distances) -> np.ndarray:
+        """Coordinates of the points at the distances along the shape.
+
+        Distances are clipped to the ends of the shape.
+        """
+        distances = np.clip(np.asarray(distances, dtype=float), 0.0, self.length)
+        if len(self.coords) < 2:
+            return np.broadcast_to(self.coords[0], distances.shape + (2,)).copy()
+
+        segment = np.clip(
+            np.searchsorted(self.distances, distances, side="right") - 1,
+            0,
+            len(self.coords) - 2,
+        )
+        segment_length = self.distances[segment + 1] - self.distances[segment]
+        fraction = np.divide(
+            distances - self.distances[segment],
+            segment_length,
+            out=np.zeros_like(distances),
+            where=segment_length > 0,
+        )[..., np.newaxis]
+
+        before, after = self.coords[segment], self.coords[segment + 1]
+        return before + fraction * (after - before)
+
+    def segment_coords(self, start: float, end: float) -> np.ndarray:
+        """Coordinates of the part of the shape between two distances along it."""
+        start, end = np.clip([start, end], 0.0, self.length)
+        end = max(start, end)
+
+        first = np.searchsorted(self.distances, start, side="right")
+        last = np.searchsorted(self.distances, end, side="left")
+
+        return np.concatenate(
+            [
+                self.interpolate([start]),
+                self.coords[first:last],
+                self.interpolate([end]),
+            ]
+        )
+
+    def segment(self, start: float, end: float):
+        """LineString of the part of the shape between two distances along it."""
+        from shapely.geometry import LineString
+
+        return LineString(self.segment_coords(start, end))
+
+    def project(self, x: float, y: float, start: Optional[float] = 0.0) -> float:
+        """Distance along the shape to the point nearest (x, y), at or after start.
+
+        :param x: Coordinate of the point, in the crs of the shape
+        :param y: Coordinate of the point, in the crs of the shape
+        :param start: Distance along the shape before which points are not considered
+        :return: The distance along the shape
+        """
+        start = min(max(start, 0.0), self.length)
+        if len(self.coords) < 2:
+            return start
+
+        first = min(
+            np.searchsorted(self.distances, start, side="right") - 1,
+            len(self.coords) - 2,
+        )
+        a = self.coords[first:-1].copy()
+        a[0] = self.interpolate(start)
+        b = self.coords[first + 1 :]
+        a_distances = self.distances[first:-1].copy()
+        a_distances[0] = start
+
+        ab = b - a
+        ab_length = np.hypot(ab[:, 0], ab[:, 1])
+        fraction = np.clip(
+            np.divide(
+                (x - a[:, 0]) * ab[:, 0] + (y - a[:, 1]) * ab[:, 1],
+                ab_length**2,
+                out=np.zeros(len(ab)),
+                where=ab_length > 0,
+            ),
+            0.0,
+            1.0,
+        )
+        nearest = a + fraction[:, np.newaxis] * ab
+        closest = np.argmin(np.hypot(nearest[:, 0] - x, nearest[:, 1] - y))
+
+        return float(a_distances[closest] + fraction[closest] * ab_length[closest])
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# The fixture feed and the reference implementations are shared with the benchmarks
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+)
+
+
+@pytest.fixture(scope="session")
+def fixture_path(tmp_path_factory):
+    from fixture_feed import FIXTURE_NAME, write_fixture_feed
+
+    return write_fixture_feed(str(tmp_path_factory.mktemp("gtfs") / FIXTURE_NAME))
+
+
+@pytest.fixture(scope="session")
+def feed(fixture_path):
+    import partridge as ptg
+
+    _, service_ids = ptg.read_busiest_date(fixture_path)
+    return ptg.load_geo_feed(fixture_path, {"trips.txt": {"service_id": service_ids}})
+
+
+@pytest.fixture(scope="session")
+def timetable(feed):
+    from gtfs_router.raptor import compile_timetable
+
+    return compile_timetable(feed, feed.transfers)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_router.raptor import batch_assignment, raptor_assignment
+
+
+@pytest.fixture(scope="module")
+def od_records(feed):
+    rng = np.random.default_rng(1)
+    stop_ids = np.sort(feed.stops["stop_id"].to_numpy())
+    from_stops = rng.choice(stop_ids, 12)
+
+    # origins sharing a departure time are answered by one-to-all queries
+    return pd.DataFrame(
+        {
+            "from_stop_id": np.repeat(from_stops, 3),
+            "to_stop_id": rng.choice(stop_ids, 36),
+            "departure_time": np.repeat(
+                rng.integers(6 * 60 * 60, 9 * 60 * 60, 12).astype(float), 3
+            ),
+        }
+    ).iloc[:-2]
+
+
+def test_results_equal_across_workers(timetable, od_records):
+    single = batch_assignment(None, od_records, None, 2, timetable=timetable, workers=1)
+    pooled = batch_assignment(
+        None, od_records, None, 2, timetable=timetable, workers=3, chunk_size=2
+    )
+
+    pd.testing.assert_frame_equal(pooled, single)
+
+
+def test_results_match_single_queries(feed, timetable, od_records):
+    results = batch_assignment(
+        None, od_records, None, 2, timetable=timetable, workers=2
+    )
+
+    for od in results.itertuples():
+        state = raptor_assignment(
+            None,
+            od.from_stop_id,
+            od.to_stop_id,
+            od.departure_time,
+            None,
+            2,
+            timetable=timetable,
+        )
+        expected = (
+            od.departure_time + state.get_stop(od.to_stop_id)["time_to_reach"]
+            if state.has_stop(od.to_stop_id)
+            else np.nan
+        )
+        np.testing.assert_equal(od.arrival_time, expected)
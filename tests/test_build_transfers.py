@@ -0,0 +1,110 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_router.utils import build_transfers
+from gtfs_router.utils.build_transfers import (
+    APPEND,
+    find_transfers,
+    iter_transfers,
+    update_transfers,
+)
+
+PAIR_COLUMNS = ["from_stop_id", "to_stop_id"]
+
+
+def _grid_stops(size: int, spacing: float = 0.001) -> pd.DataFrame:
+    """Stops on a square grid, about 100 meters apart with the default spacing."""
+    i, j = np.divmod(np.arange(size * size), size)
+    return pd.DataFrame(
+        {
+            "stop_id": [str(n) for n in range(size * size)],
+            "stop_lat": 38.5 + i * spacing,
+            "stop_lon": -121.5 + j * spacing * 1.27,
+        }
+    )
+
+
+def _sorted(transfers: pd.DataFrame) -> pd.DataFrame:
+    return transfers.sort_values(PAIR_COLUMNS).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("epsg", [5070, None])
+def test_tiles_hold_the_transfers_of_the_whole_feed(epsg):
+    stops = _grid_stops(30)
+
+    transfers = find_transfers(stops, epsg=epsg)
+    tiled = pd.concat(iter_transfers(stops, epsg=epsg, tile_size=700))
+
+    assert len(transfers) > 0
+    pd.testing.assert_frame_equal(_sorted(tiled), _sorted(transfers))
+
+
+@pytest.mark.parametrize("epsg", [5070, None])
+def test_stops_without_coordinates_are_left_out(epsg):
+    stops = _grid_stops(20)
+    generic_node = pd.DataFrame(
+        {"stop_id": ["node"], "stop_lat": [np.nan], "stop_lon": [np.nan]}
+    )
+
+    transfers = find_transfers(stops, epsg=epsg)
+    with_node = find_transfers(pd.concat([generic_node, stops]), epsg=epsg)
+
+    pd.testing.assert_frame_equal(_sorted(with_node), _sorted(transfers))
+
+
+def test_stop_without_coordinates_keeps_the_grid_search():
+    stops = _grid_stops(80)
+    generic_node = pd.DataFrame(
+        {"stop_id": ["node"], "stop_lat": [np.nan], "stop_lon": [np.nan]}
+    )
+    stops_with_node = pd.concat([stops, generic_node])
+
+    start = time.perf_counter()
+    find_transfers(stops, epsg=None)
+    without_node = time.perf_counter() - start
+
+    start = time.perf_counter()
+    find_transfers(stops_with_node, epsg=None)
+    with_node = time.perf_counter() - start
+
+    # a cross join of the 6400 stops takes seconds, the grid search milliseconds
+    assert with_node < max(20 * without_node, 1.0)
+
+
+def _write_stops(gtfs_path, stops: pd.DataFrame) -> str:
+    gtfs_path.mkdir(exist_ok=True)
+    stops.to_csv(gtfs_path / "stops.txt", index=False)
+    return str(gtfs_path)
+
+
+def test_streamed_transfers_match_those_written_at_once(tmp_path):
+    stops = _grid_stops(30)
+    at_once = _write_stops(tmp_path / "at_once", stops)
+    streamed = _write_stops(tmp_path / "streamed", stops)
+
+    update_transfers(at_once)
+    update_transfers(streamed, tile_size=700)
+
+    expected = pd.read_csv(os.path.join(at_once, "transfers.txt"))
+    written = pd.read_csv(os.path.join(streamed, "transfers.txt"))
+    pd.testing.assert_frame_equal(_sorted(written), _sorted(expected))
+    assert sorted(os.listdir(streamed)) == ["stops.txt", "transfers.txt"]
+
+
+def test_failed_stream_leaves_the_feed_as_it_was(tmp_path, monkeypatch):
+    gtfs_path = _write_stops(tmp_path, _grid_stops(10))
+    (tmp_path / "transfers.txt").write_text("from_stop_id,to_stop_id\n1,2\n")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("tile failed")
+
+    monkeypatch.setattr(build_transfers, "iter_transfers", fail)
+    with pytest.raises(RuntimeError):
+        update_transfers(gtfs_path, APPEND, tile_size=700)
+
+    assert sorted(os.listdir(gtfs_path)) == ["stops.txt", "transfers.txt"]
+    assert (tmp_path / "transfers.txt").read_text() == "from_stop_id,to_stop_id\n1,2\n"
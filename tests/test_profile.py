@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from gtfs_router.raptor import raptor_assignment, raptor_profile
+
+TRANSFER_LIMIT = 2
+
+
+def _best_by_transfers(front, transfer_limit):
+    """Earliest arrival using at most each number of transfers."""
+    best = np.full(transfer_limit + 1, np.inf)
+    for transfers, arrival_time, _ in front:
+        best[transfers:] = np.minimum(best[transfers:], arrival_time)
+    return best
+
+
+@pytest.mark.parametrize("from_stop_id", ["150", "189", "257"])
+def test_profile_matches_pareto_of_each_departure(feed, timetable, from_stop_id):
+    journeys = raptor_profile(
+        feed,
+        from_stop_id,
+        7 * 60 * 60,
+        7.5 * 60 * 60,
+        feed.transfers,
+        TRANSFER_LIMIT,
+        timetable=timetable,
+    )
+    departures = np.unique(journeys["departure_time"])
+    assert len(departures) > 0
+
+    for departure in departures:
+        state = raptor_assignment(
+            feed,
+            from_stop_id,
+            None,
+            departure,
+            feed.transfers,
+            TRANSFER_LIMIT,
+            timetable=timetable,
+        )
+
+        # leaving later is never better than waiting for the same journey
+        later = journeys[journeys["departure_time"] >= departure]
+        for to_stop_id in timetable.stop_ids:
+            if to_stop_id == from_stop_id:
+                continue
+
+            expected = np.full(TRANSFER_LIMIT + 1, np.inf)
+            if state.has_stop(to_stop_id):
+                expected = _best_by_transfers(state.pareto(to_stop_id), TRANSFER_LIMIT)
+
+            to_stop = later[later["to_stop_id"] == to_stop_id]
+            profile = np.full(TRANSFER_LIMIT + 1, np.inf)
+            for transfers, arrival_time in zip(
+                to_stop["transfers"], to_stop["arrival_time"]
+            ):
+                profile[transfers:] = np.minimum(profile[transfers:], arrival_time)
+
+            np.testing.assert_array_equal(
+                profile, expected, err_msg="{} at {}".format(to_stop_id, departure)
+            )
+
+
+def test_profile_walks_to_nearby_stops(feed, timetable):
+    journeys = raptor_profile(
+        feed, "150", 7 * 60 * 60, 7.5 * 60 * 60, feed.transfers, 0, timetable=timetable
+    )
+    walk_times = feed.transfers.set_index(["from_stop_id", "to_stop_id"])[
+        "min_transfer_time"
+    ]
+
+    to_stop_id = walk_times.loc["150"].idxmin()
+    walks = journeys[
+        (journeys["to_stop_id"] == to_stop_id)
+        & (
+            journeys["arrival_time"]
+            == journeys["departure_time"] + walk_times.loc[("150", to_stop_id)]
+        )
+    ]
+    assert len(walks) > 0
+    assert (walks["transfers"] == 0).all()
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_router.raptor import batch_assignment, raptor_assignment
+
+
+def test_unknown_destination_raises(feed, timetable):
+    with pytest.raises(KeyError, match="No stop_id found for: 9999"):
+        raptor_assignment(
+            feed, "150", "9999", 25506, feed.transfers, 2, timetable=timetable
+        )
+
+
+def test_batch_leaves_unknown_destinations_unreached(feed, timetable):
+    od_records = pd.DataFrame(
+        {
+            "from_stop_id": ["150", "189"],
+            "to_stop_id": ["9999", "201"],
+            "departure_time": [25506.0, 25506.0],
+        }
+    )
+
+    results = batch_assignment(
+        None, od_records, None, 2, timetable=timetable, workers=1
+    )
+
+    assert np.isnan(results["arrival_time"].iloc[0])
+    assert results["legs"].iloc[0] == []
+    assert results["arrival_time"].iloc[1] > 25506
+
+
+@pytest.mark.parametrize("geometry", [True, False])
+def test_describe_path_requires_a_feed(timetable, geometry):
+    state = raptor_assignment(None, "150", "201", 25506, None, 2, timetable=timetable)
+
+    assert len(state.get_legs("201")) > 0
+    with pytest.raises(ValueError, match="A feed is required"):
+        state.describe_path("201", geometry=geometry)
+    with pytest.raises(ValueError, match="A feed is required"):
+        state.describe_paths(["201"], geometry=geometry)
+
+
+def _queries(feed, count: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    stop_ids = np.sort(feed.stops["stop_id"].to_numpy())
+    from_stops, to_stops = (rng.choice(stop_ids, count) for _ in range(2))
+    keep = from_stops != to_stops
+    return pd.DataFrame(
+        {
+            "from_stop_id": from_stops[keep],
+            "to_stop_id": to_stops[keep],
+            "departure_time": rng.integers(6 * 60 * 60, 9 * 60 * 60, keep.sum()),
+        }
+    )
+
+
+@pytest.mark.parametrize("transfer_limit", [0, 2])
+def test_compiled_timetable_matches_trip_scan(feed, timetable, transfer_limit):
+    from oracles import TripScan
+
+    scan = TripScan(feed)
+    for from_stop_id, to_stop_id, departure_time in _queries(feed, 60).itertuples(
+        index=False
+    ):
+        state = raptor_assignment(
+            feed,
+            from_stop_id,
+            to_stop_id,
+            departure_time,
+            feed.transfers,
+            transfer_limit,
+            timetable=timetable,
+        )
+        arrival_time = (
+            departure_time + state.get_stop(to_stop_id)["time_to_reach"]
+            if state.has_stop(to_stop_id)
+            else np.nan
+        )
+
+        np.testing.assert_equal(
+            arrival_time,
+            scan.arrival(from_stop_id, to_stop_id, departure_time, transfer_limit),
+            err_msg="{}->{} at {}".format(from_stop_id, to_stop_id, departure_time),
+        )
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gtfs_router.raptor import build_skims, raptor_assignment
+
+
+def _has_parquet_engine():
+    try:
+        pd.io.parquet.get_engine("auto")
+    except ImportError:
+        return False
+    return True
+
+
+def test_dense_skims_hold_the_travel_times(timetable, tmp_path):
+    from_stop_ids = ["150", "189"]
+    build_skims(None, from_stop_ids, 25506, None, 2, str(tmp_path), timetable=timetable)
+
+    travel_times = np.load(os.path.join(tmp_path, "travel_time_00000.npy"))
+    for row, from_stop_id in enumerate(from_stop_ids):
+        state = raptor_assignment(
+            None, from_stop_id, None, 25506, None, 2, timetable=timetable
+        )
+        expected = [
+            (
+                state.get_stop(stop_id)["time_to_reach"]
+                if state.has_stop(stop_id)
+                else np.nan
+            )
+            for stop_id in timetable.stop_ids
+        ]
+        np.testing.assert_array_equal(travel_times[row], expected)
+
+
+@pytest.mark.skipif(_has_parquet_engine(), reason="a parquet engine is installed")
+def test_parquet_without_an_engine_fails_before_routing(timetable, tmp_path):
+    output_dir = str(tmp_path / "skims")
+
+    with pytest.raises(ImportError):
+        build_skims(
+            None,
+            ["150"],
+            25506,
+            None,
+            2,
+            output_dir,
+            timetable=timetable,
+            file_format="parquet",
+        )
+    assert not os.path.exists(output_dir)
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from gtfs_router.raptor import QueryStats, batch_assignment, raptor_assignment
+
+OD_RECORDS = pd.DataFrame(
+    {
+        "from_stop_id": ["150", "189", "257", "150"],
+        "to_stop_id": ["201", "112", "230", "243"],
+        "departure_time": [25506.0, 27000.0, 26100.0, 28800.0],
+    }
+)
+
+
+def test_callback_fires_as_each_round_ends(feed, timetable):
+    ended = []
+    stats = QueryStats(callback=lambda k, counters: ended.append((k, stats.queries)))
+
+    raptor_assignment(
+        feed, "150", None, 25506, feed.transfers, 2, timetable=timetable, stats=stats
+    )
+
+    assert [k for k, _ in ended] == list(range(len(stats.rounds)))
+    # every round ended before the query was added to the totals
+    assert all(queries == 0 for _, queries in ended)
+    assert stats.queries == 1
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_callback_fires_for_batch_queries(feed, timetable, workers):
+    direct_rounds = []
+    direct = QueryStats(callback=lambda k, counters: direct_rounds.append(k))
+    for od in OD_RECORDS.itertuples():
+        raptor_assignment(
+            None,
+            od.from_stop_id,
+            od.to_stop_id,
+            od.departure_time,
+            None,
+            2,
+            timetable=timetable,
+            stats=direct,
+        )
+
+    batch_rounds = []
+    stats = QueryStats(callback=lambda k, counters: batch_rounds.append(k))
+    batch_assignment(
+        None, OD_RECORDS, None, 2, timetable=timetable, workers=workers, stats=stats
+    )
+
+    assert len(batch_rounds) > 0
+    assert batch_rounds == direct_rounds
+    assert stats.to_dict()["queries"] == direct.queries
+    pd.testing.assert_frame_equal(
+        stats.to_frame().drop(columns=["scan_time", "footpath_time"]),
+        direct.to_frame().drop(columns=["scan_time", "footpath_time"]),
+    )